@@ -0,0 +1,427 @@
+"""Headless end-to-end benchmarks for Retrochat.
+
+Starts a local mock backend that speaks the OpenAI-style (/v1/chat/completions)
+and Ollama (/api/chat) protocols, then drives the real Chatbox under Qt's
+offscreen platform and reports:
+
+  - startup time (retrochat.py --profile-startup in a fresh process)
+  - per-turn overhead of send_message/handle_response against an instant backend
+  - chat open/render time vs. chat length
+  - save and load time vs. history size
+
+Usage:
+    python benchmark.py [--sizes 100 1000 5000] [--turns 20] [--latency 0]
+                        [--token-rate 0] [--reply-tokens 200] [--json results.json]
+                        [--record traffic.jsonl | --replay traffic.jsonl [--replay-speed 1]]
+
+--record saves the request benchmark's traffic (see Transport in retrochat_core.py),
+and --replay serves the turns from such a file instead of the mock server, so
+a run against real backends can be reproduced offline.
+
+Everything runs in a temporary directory, so existing chats and config are
+never touched.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class MockBackendHandler(BaseHTTPRequestHandler):
+    """OpenAI- and Ollama-compatible endpoints with configurable timing.
+
+    The server's latency (seconds before the response headers), token_rate
+    (tokens per second, 0 for as fast as possible) and reply_tokens are read
+    from the owning MockBackend.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self.send_json({"models": [{"name": "mock"}]})
+        elif self.path == "/api/ps":
+            self.send_json({"models": [{"name": "mock"}]})
+        else:
+            self.send_json({"status": "ok"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        backend = self.server.backend
+        backend.requests += 1
+
+        if self.path == "/api/chat" and not body.get("messages"):
+            # Ollama model preload.
+            self.send_json({"done": True})
+            return
+
+        time.sleep(backend.latency)
+        tokens = backend.reply()
+        delay = 1 / backend.token_rate if backend.token_rate else 0
+        timings = {"prompt_n": len(body.get("messages", [])), "prompt_ms": backend.latency * 1000,
+                   "predicted_n": len(tokens), "predicted_ms": len(tokens) * delay * 1000}
+
+        if self.path == "/api/chat":
+            if body.get("stream", True):
+                self.start_stream("application/x-ndjson")
+                for token in tokens:
+                    self.send_chunk(json.dumps({"message": {"role": "assistant", "content": token}, "done": False}) + "\n")
+                    time.sleep(delay)
+                self.send_chunk(json.dumps({"message": {"role": "assistant", "content": ""}, "done": True,
+                                            "eval_count": len(tokens), "eval_duration": int(timings["predicted_ms"] * 1e6)}) + "\n")
+                self.send_chunk("")
+            else:
+                time.sleep(delay * len(tokens))
+                self.send_json({"message": {"role": "assistant", "content": "".join(tokens)}, "done": True,
+                                "eval_count": len(tokens), "eval_duration": int(timings["predicted_ms"] * 1e6)})
+            return
+
+        if body.get("stream"):
+            self.start_stream("text/event-stream")
+            for token in tokens:
+                self.send_chunk("data: " + json.dumps({"choices": [{"delta": {"content": token}}]}) + "\n\n")
+                time.sleep(delay)
+            self.send_chunk("data: " + json.dumps({"choices": [], "timings": timings}) + "\n\n")
+            self.send_chunk("data: [DONE]\n\n")
+            self.send_chunk("")
+        else:
+            time.sleep(delay * len(tokens))
+            self.send_json({"choices": [{"message": {"role": "assistant", "content": "".join(tokens)}}],
+                            "usage": {"prompt_tokens": timings["prompt_n"], "completion_tokens": len(tokens)},
+                            "timings": timings})
+
+
+class MockBackend:
+    """A mock inference server on an ephemeral localhost port."""
+
+    def __init__(self, latency=0.0, token_rate=0.0, reply_tokens=200):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), MockBackendHandler)
+        self.server.backend = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reply(self):
+        """reply_tokens tokens of Markdown with a list, a table and a code block."""
+        return sample_markdown(self.reply_tokens)
+
+
+def sample_markdown(tokens):
+    words = ["The", " quick", " **brown**", " fox", " jumps", " over", " the", " `lazy`", " dog."]
+    parts = ["Here is an answer:\n\n"]
+    while len(parts) < tokens:
+        index = len(parts)
+        if index % 60 == 0:
+            parts.append("\n\n```python\nfor i in range(10):\n    print(i)\n```\n\n")
+        elif index % 45 == 0:
+            parts.append("\n\n| key | value |\n| --- | --- |\n| a | 1 |\n| b | 2 |\n\n")
+        elif index % 30 == 0:
+            parts.append("\n\n- item one\n- item two\n\n")
+        else:
+            parts.append(words[index % len(words)])
+    return parts[:max(tokens, 1)]
+
+
+def make_history(count, reply_tokens=80):
+    reply = "".join(sample_markdown(reply_tokens))
+    history = []
+    for i in range(count):
+        if i % 2 == 0:
+            history.append({"role": "user", "content": f"Question {i}: how does *this* work?"})
+        else:
+            history.append({"role": "assistant", "content": reply})
+    return history
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda p: values[min(int(p / 100 * len(values)), len(values) - 1)]
+    return {"min": values[0], "median": statistics.median(values), "p90": pick(90), "max": values[-1]}
+
+
+def ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def write_config(directory, backend, extra=None):
+    config = {
+        "ollamahost": backend.host,
+        "llamacpphost": backend.host,
+        "current_mode": "llama.cpp",
+        "current_chat_filename": "bench.json",
+        "summarize": False
+    }
+    config.update(extra or {})
+    with open(os.path.join(directory, "config.json"), 'w') as file:
+        json.dump(config, file)
+
+
+def bench_startup(backend, runs):
+    """Median wall time and in-process profile of `retrochat.py --profile-startup`."""
+    totals, walls = [], []
+    for _ in range(runs):
+        directory = tempfile.mkdtemp(prefix="retrochat-bench-")
+        try:
+            write_config(directory, backend)
+            started = time.perf_counter()
+            result = subprocess.run([sys.executable, os.path.join(REPO_DIR, "retrochat.py"), "--profile-startup"],
+                                    cwd=directory, capture_output=True, text=True, timeout=60)
+            walls.append(time.perf_counter() - started)
+            for line in result.stderr.splitlines():
+                if line.startswith("total"):
+                    totals.append(float(line.split()[1]) / 1000)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return {"profiled_ms": {k: ms(v) for k, v in percentiles(totals).items()},
+            "process_ms": {k: ms(v) for k, v in percentiles(walls).items()}}
+
+
+class Harness:
+    """Owns the QApplication and an instrumented Chatbox in a scratch directory."""
+
+    def __init__(self, backend, transport="live", traffic_file=None, replay_speed=1.0):
+        self.backend = backend
+        self.transport = transport
+        self.traffic_file = traffic_file
+        self.directory = tempfile.mkdtemp(prefix="retrochat-bench-")
+        self.previous_directory = os.getcwd()
+        os.chdir(self.directory)
+        write_config(self.directory, backend, {"transport": transport, "replay_speed": replay_speed})
+        if transport == "replay":
+            os.makedirs(".retrochat", exist_ok=True)
+            shutil.copyfile(traffic_file, os.path.join(".retrochat", "traffic.jsonl"))
+
+        sys.path.insert(0, REPO_DIR)
+        import retrochat
+        from PyQt5.QtWidgets import QApplication
+        self.retrochat = retrochat
+        self.app = QApplication.instance() or QApplication([])
+
+        class TimedChatbox(retrochat.Chatbox):
+            """Chatbox that records how long the GUI thread spends handling each reply."""
+            response_seconds = []
+
+            def handle_response(self, response):
+                started = time.perf_counter()
+                super().handle_response(response)
+                self.response_seconds.append(time.perf_counter() - started)
+
+        self.chatbox = TimedChatbox()
+        self.wait(lambda: self.chatbox.llamacpp_online is not None)
+        self.chatbox.mode = "llama.cpp"
+
+    def wait(self, condition, timeout=60):
+        """Run the event loop until condition() holds; return the longest single pass in seconds."""
+        deadline = time.perf_counter() + timeout
+        longest = 0
+        while not condition():
+            if time.perf_counter() > deadline:
+                raise TimeoutError("benchmark step timed out")
+            started = time.perf_counter()
+            self.app.processEvents()
+            longest = max(longest, time.perf_counter() - started)
+            time.sleep(0.0005)
+        self.app.processEvents()
+        return longest
+
+    def close(self):
+        self.retrochat.ConfigManager.flush()
+        self.retrochat.ChatCatalog.flush()
+        recorded = os.path.join(".retrochat", "traffic.jsonl")
+        if self.transport == "record" and os.path.exists(recorded):
+            shutil.copyfile(recorded, self.traffic_file)
+        os.chdir(self.previous_directory)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def bench_turns(harness, turns, stream):
+    """Time full turns and the GUI-thread share of send_message and handle_response."""
+    chatbox = harness.chatbox
+    chatbox.config["stream"] = stream
+    chatbox.open_chat(f"turns-{'stream' if stream else 'plain'}.json")
+    chatbox.response_seconds.clear()
+
+    turn_seconds, send_seconds = [], []
+    for turn in range(turns):
+        replies = len(chatbox.response_seconds)
+        started = time.perf_counter()
+        chatbox.send_message(f"Turn {turn}: tell me something")
+        send_seconds.append(time.perf_counter() - started)
+        harness.wait(lambda: len(chatbox.response_seconds) > replies and not chatbox.scheduler.active)
+        turn_seconds.append(time.perf_counter() - started)
+
+    backend = harness.backend
+    server_seconds = backend.latency + (backend.reply_tokens / backend.token_rate if backend.token_rate else 0)
+    if harness.transport == "replay":
+        # The recorded pacing is not known up front; overhead equals turn time.
+        server_seconds = 0
+    return {
+        "turn_ms": {k: ms(v) for k, v in percentiles(turn_seconds).items()},
+        "overhead_ms": {k: ms(max(v - server_seconds, 0)) for k, v in percentiles(turn_seconds).items()},
+        "send_message_ms": {k: ms(v) for k, v in percentiles(send_seconds).items()},
+        "handle_response_ms": {k: ms(v) for k, v in percentiles(chatbox.response_seconds).items()}
+    }
+
+
+def bench_render(harness, sizes):
+    """Time opening chats of each size, with a cold and a warm render cache.
+
+    Messages are rendered and added to the display in the background, so
+    first_paint_ms is when open_chat returns and max_stall_ms is the longest
+    the event loop was blocked while the rest filled in.
+    """
+    chatbox = harness.chatbox
+    manager_class = harness.retrochat.ChatHistoryManager
+    results = {}
+    for size in sizes:
+        filename = f"render-{size}.json"
+        manager_class(filename).save_chat_history(make_history(size), "")
+
+        chatbox.render_cache.entries.clear()
+        started = time.perf_counter()
+        chatbox.open_chat(filename)
+        first_paint = time.perf_counter() - started
+        stall = harness.wait(lambda: not chatbox.display_busy())
+        cold = time.perf_counter() - started
+
+        started = time.perf_counter()
+        chatbox.load_chat_to_display()
+        warm_stall = harness.wait(lambda: not chatbox.display_busy())
+        warm = time.perf_counter() - started
+        results[size] = {"first_paint_ms": ms(first_paint), "open_cold_ms": ms(cold),
+                         "redisplay_warm_ms": ms(warm), "max_stall_ms": ms(max(stall, warm_stall)),
+                         "blocks": chatbox.chat_history.document().blockCount()}
+    return results
+
+
+def bench_save(harness, sizes):
+    """Time a full rewrite, a one-turn append and a load for histories of each size."""
+    manager_class = harness.retrochat.ChatHistoryManager
+    results = {}
+    for size in sizes:
+        filename = f"save-{size}.json"
+        history = make_history(size)
+        manager = manager_class(filename)
+
+        started = time.perf_counter()
+        manager.save_chat_history(history, "")
+        full = time.perf_counter() - started
+
+        history = history + [{"role": "user", "content": "one more"}, {"role": "assistant", "content": "ok"}]
+        started = time.perf_counter()
+        manager.save_chat_history(history, "")
+        append = time.perf_counter() - started
+
+        started = time.perf_counter()
+        manager_class(filename).load_chat_history()
+        load = time.perf_counter() - started
+        results[size] = {"full_write_ms": ms(full), "append_turn_ms": ms(append), "load_ms": ms(load),
+                         "file_kb": round(os.path.getsize(filename) / 1024, 1)}
+    return results
+
+
+def print_table(title, rows, columns):
+    print(f"\n{title}")
+    header = f"{'':>20}" + "".join(f"{column:>20}" for column in columns)
+    print(header)
+    for name, values in rows.items():
+        print(f"{str(name):>20}" + "".join(f"{values.get(column, ''):>20}" for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless Retrochat benchmarks against a mock backend.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000], help="history sizes (messages)")
+    parser.add_argument("--turns", type=int, default=20, help="turns per request benchmark")
+    parser.add_argument("--startup-runs", type=int, default=3, help="fresh processes for the startup benchmark")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock server latency before headers (s)")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="mock tokens per second (0 = unlimited)")
+    parser.add_argument("--reply-tokens", type=int, default=200, help="tokens per mock reply")
+    parser.add_argument("--json", help="also write the results to this file")
+    traffic = parser.add_mutually_exclusive_group()
+    traffic.add_argument("--record", help="save the request benchmark's traffic to this file")
+    traffic.add_argument("--replay", help="serve the request benchmark from traffic saved with --record")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="replay pace relative to the recording (0 = no delays)")
+    args = parser.parse_args()
+
+    transport, traffic_file = "live", None
+    if args.record:
+        transport, traffic_file = "record", os.path.abspath(args.record)
+    elif args.replay:
+        transport, traffic_file = "replay", os.path.abspath(args.replay)
+
+    backend = MockBackend(args.latency, args.token_rate, args.reply_tokens).start()
+    results = {"startup": bench_startup(backend, args.startup_runs)}
+
+    harness = Harness(backend, transport, traffic_file, args.replay_speed)
+    try:
+        results["turns_stream"] = bench_turns(harness, args.turns, stream=True)
+        results["turns_plain"] = bench_turns(harness, args.turns, stream=False)
+        results["render"] = bench_render(harness, args.sizes)
+        results["save"] = bench_save(harness, args.sizes)
+    finally:
+        harness.close()
+        backend.stop()
+
+    print_table("Startup (ms)", {"profiled": results["startup"]["profiled_ms"], "process": results["startup"]["process_ms"]},
+                ["min", "median", "p90", "max"])
+    for key in ("turns_stream", "turns_plain"):
+        print_table(f"Per turn, {key.split('_')[1]} (ms)", results[key], ["min", "median", "p90", "max"])
+    print_table("Chat open vs. length", results["render"], ["first_paint_ms", "open_cold_ms", "redisplay_warm_ms", "max_stall_ms", "blocks"])
+    print_table("Save/load vs. history size", results["save"], ["full_write_ms", "append_turn_ms", "load_ms", "file_kb"])
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,52 @@
+import time
+STARTUP_BEGIN = time.perf_counter()
+
 import os
 import sys
-import json
-import requests
-import markdown
 import shutil
-import ctypes
-from ctypes import windll, byref, c_int, sizeof
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QTextEdit, QLineEdit, QScrollArea, QHBoxLayout, QFrame, QLabel, QPushButton, QDialog, QFormLayout, QComboBox, QSpinBox
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QPoint
-from PyQt5.QtGui import QTextCursor, QFont, QIcon, QPixmap
+import threading
+from html import escape
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+# markdown is imported where it is first used, so it stays off the startup path.
+from retrochat_core import (
+    ConfigManager, ChatHistoryManager, ChatCatalog, SearchIndex, RenderCache, ContextWindow,
+    SessionPool, HostBalancer, MetricsStore, ResponseCache, ChatRequest, build_messages, build_chat_request, pick_host,
+    logger, configure_logging
+)
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QTextEdit, QLineEdit, QScrollArea, QHBoxLayout, QFrame, QLabel, QPushButton, QDialog, QFormLayout, QComboBox
+from PyQt5.QtCore import Qt, QObject, QThread, QTimer, pyqtSignal, QPoint
+from PyQt5.QtGui import QTextCursor, QTextCharFormat, QColor, QFont, QIcon, QPixmap
+
+
+class StartupProfiler:
+    """Times the phases of application startup for --profile-startup."""
+    phases = []
+    last_mark = STARTUP_BEGIN
+
+    @classmethod
+    def mark(cls, phase):
+        now = time.perf_counter()
+        cls.phases.append((phase, now - cls.last_mark))
+        cls.last_mark = now
+
+    @classmethod
+    def report(cls, stream=sys.stderr):
+        total = 0.0
+        for phase, seconds in cls.phases:
+            total += seconds
+            stream.write(f"{phase:<24}{seconds * 1000:9.1f} ms\n")
+        stream.write(f"{'total':<24}{total * 1000:9.1f} ms\n")
+        stream.flush()
+
+
+StartupProfiler.mark("imports")
 
 
 def set_amoled_black_title_bar(window):
     if sys.platform == 'win32':
+        from ctypes import windll, byref, c_int, sizeof
+
         hwnd = int(window.winId())
 
         DWMWA_USE_IMMERSIVE_DARK_MODE = 20
@@ -26,211 +60,226 @@ def set_amoled_black_title_bar(window):
         windll.dwmapi.DwmSetWindowAttribute(hwnd, DWMWA_CAPTION_COLOR, byref(c_int(black_color)), sizeof(c_int))
 
 
-class ConfigManager:
-    CONFIG_FILENAME = "config.json"
-    DEFAULT_CONFIG = {
-        "baseurl": "http://",
-        "ollamahost": "192.168.1.82:11434",
-        "llamacpphost": "192.168.1.82:8080",
-        "path": "/v1/chat/completions",
-        "user_color": "#00FF00",
-        "assistant_color": "#FFBF00",
-        "fontsize": 18,
-        "current_chat_filename": "",
-        "selected_model": "",
-        "current_mode": "",
-        "openaiapikey": "",
-        "window_geometry": None,
-        "window_state": "normal"
-    }
+class NetworkWorker(QThread):
+    """Runs a ChatRequest off the GUI thread and relays its progress as signals."""
+    response_received = pyqtSignal(str)
+    token_received = pyqtSignal(str)
+    timings_received = pyqtSignal(dict)
+    error_occurred = pyqtSignal(str)
 
-    @classmethod
-    def load_config(cls):
-        config_path = os.path.join(os.getcwd(), cls.CONFIG_FILENAME)
-        if not os.path.exists(config_path):
-            cls.save_config(cls.DEFAULT_CONFIG)
-            return cls.DEFAULT_CONFIG
-        try:
-            with open(config_path, 'r') as config_file:
-                config = json.load(config_file)
-                return cls.check_and_update_config(config)
-        except (json.JSONDecodeError, Exception):
-            cls.rename_old_file(cls.CONFIG_FILENAME)
-            cls.save_config(cls.DEFAULT_CONFIG)
-            return cls.DEFAULT_CONFIG
+    def __init__(self, conversation_history, endpoint, data, headers=None, stream=False, protocol="openai", route=None):
+        super().__init__()
+        self.conversation_history = conversation_history
+        self.chat_filename = None
+        self.request = ChatRequest(endpoint, data, headers, stream=stream, protocol=protocol, route=route)
+        self.request.on_token = self.token_received.emit
+        self.request.on_timings = self.timings_received.emit
+        self.request.on_response = self.response_received.emit
+        self.request.on_error = self.error_occurred.emit
 
-    @classmethod
-    def save_config(cls, config):
-        config_path = os.path.join(os.getcwd(), cls.CONFIG_FILENAME)
-        with open(config_path, 'w') as config_file:
-            json.dump(config, config_file, indent=4)
+    def run(self):
+        self.request.run()
 
-    @classmethod
-    def save_window_state(cls, geometry, state):
-        config = cls.load_config()
-        config['window_geometry'] = geometry
-        config['window_state'] = state
-        cls.save_config(config)
+    def cancel(self):
+        self.request.cancel()
 
-    @classmethod
-    def save_config_value(cls, key, value):
-        config = cls.load_config()
-        config[key] = value
-        cls.save_config(config)
 
-    @classmethod
-    def check_and_update_config(cls, config):
-        if isinstance(config, dict):
-            updated_config = cls.update_to_match_default(config, cls.DEFAULT_CONFIG)
-            if updated_config != config:
-                cls.save_config(updated_config)
-            return updated_config
-        else:
-            cls.rename_old_file(cls.CONFIG_FILENAME)
-            cls.save_config(cls.DEFAULT_CONFIG)
-            return cls.DEFAULT_CONFIG
+class RequestScheduler:
+    """Keeps one generation running per chat and queues follow-up messages behind it."""
 
-    @classmethod
-    def update_to_match_default(cls, data, default_structure):
-        if not isinstance(data, dict) or not isinstance(default_structure, dict):
-            return default_structure
-
-        updated_data = data.copy()
-        for key, default_value in default_structure.items():
-            if key not in updated_data:
-                updated_data[key] = default_value
-            elif isinstance(default_value, dict):
-                updated_data[key] = cls.update_to_match_default(updated_data[key], default_value)
-        return updated_data
-
-    @staticmethod
-    def rename_old_file(filename):
-        old_file_path = os.path.join(os.getcwd(), filename)
-        new_file_path = os.path.join(os.getcwd(), f"OLD_{filename}")
-        if os.path.exists(old_file_path):
-            shutil.move(old_file_path, new_file_path)
-
-
-class ChatHistoryManager:
-    def __init__(self, chat_filename="chat_1.json"):
-        self.chat_filename = chat_filename
-
-    def save_chat_history(self, chat_history, system_prompt):
-        chat_data = {
-            "system_prompt": system_prompt,
-            "conversation_history": chat_history
-        }
-        chat_history_path = os.path.join(os.getcwd(), self.chat_filename)
-        with open(chat_history_path, 'w') as file:
-            json.dump(chat_data, file, indent=4)
-        ConfigManager.save_config_value('current_chat_filename', self.chat_filename)
-
-    def load_chat_history(self):
-        chat_history_path = os.path.join(os.getcwd(), self.chat_filename)
-        if os.path.exists(chat_history_path):
-            try:
-                with open(chat_history_path, 'r') as file:
-                    chat_data = json.load(file)
-                    if isinstance(chat_data, dict):
-                        return chat_data.get("conversation_history", []), chat_data.get("system_prompt", "")
-                    else:
-                        raise json.JSONDecodeError("Invalid format", chat_history_path, 0)
-            except json.JSONDecodeError:
-                self.rename_old_file(self.chat_filename)
-                self.create_new_chat_file()
-                return [], ""
-        return [], ""
-
-    def check_and_update_json_file(self, filename, expected_structure):
-        file_path = os.path.join(os.getcwd(), filename)
-        if not os.path.exists(file_path):
-            return
+    def __init__(self):
+        self.active = {}
+        self.queues = {}
+        # Cancelled workers may still be unwinding; hold on to them until their thread ends.
+        self.retired = set()
+
+    def busy(self, chat_filename):
+        return chat_filename in self.active
+
+    def is_active(self, worker):
+        return self.active.get(worker.chat_filename) is worker
+
+    def start(self, chat_filename, worker):
+        worker.chat_filename = chat_filename
+        self.active[chat_filename] = worker
+        worker.start()
+
+    def finish(self, worker):
+        self.retired.discard(worker)
+        if self.is_active(worker):
+            del self.active[worker.chat_filename]
+
+    def enqueue(self, chat_filename, message):
+        queue = self.queues.setdefault(chat_filename, [])
+        queue.append((message, time.monotonic()))
+        return len(queue)
+
+    def next_message(self, chat_filename):
+        """Return (message, queued_at) for the chat's oldest queued message, or None."""
+        queue = self.queues.get(chat_filename)
+        if not queue:
+            return None
+        entry = queue.pop(0)
+        if not queue:
+            del self.queues[chat_filename]
+        return entry
+
+    def cancel(self, chat_filename):
+        """Abort the chat's running generation and drop its queue; return (worker, dropped)."""
+        dropped = len(self.queues.pop(chat_filename, []))
+        worker = self.active.pop(chat_filename, None)
+        if worker is not None:
+            self.retired.add(worker)
+            worker.cancel()
+        return worker, dropped
+
+    def rename(self, old_filename, new_filename):
+        if old_filename in self.active:
+            self.active[new_filename] = self.active.pop(old_filename)
+            self.active[new_filename].chat_filename = new_filename
+        if old_filename in self.queues:
+            self.queues[new_filename] = self.queues.pop(old_filename)
+
+
+class CatalogRefreshWorker(QThread):
+    """Brings ChatCatalog up to date off the GUI thread and hands back its entries."""
+    refreshed = pyqtSignal(dict)
+
+    def run(self):
+        self.refreshed.emit(ChatCatalog.refresh())
+
+
+class BackendProbeWorker(QThread):
+    """Checks the Ollama and llama.cpp hosts and lists Ollama's models off the GUI thread."""
+    probe_finished = pyqtSignal(bool, bool, list, str)
+
+    def __init__(self, config):
+        super().__init__()
+        self.baseurl = config.get("baseurl", "http://")
+        self.ollama_hosts = HostBalancer.parse_hosts(config.get("ollamahost", "127.0.0.1:11434"))
+        self.llamacpp_hosts = HostBalancer.parse_hosts(config.get("llamacpphost", "127.0.0.1:8080"))
+        timeout = float(config.get("probe_timeout", 2))
+        self.timeout = (timeout, timeout)
+
+    def run(self):
+        hosts = self.ollama_hosts + self.llamacpp_hosts
+        with ThreadPoolExecutor(max_workers=max(4, len(hosts))) as executor:
+            statuses = dict(zip(hosts, executor.map(self.check_server_status, hosts)))
+            for host, online in statuses.items():
+                HostBalancer.mark_status(host, online)
+
+            online_ollama = [host for host in self.ollama_hosts if statuses[host]]
+            models_list, models_error = [], ""
+            if online_ollama:
+                models = executor.submit(self.load_models_from_ollama, online_ollama[0])
+                loaded = list(executor.map(self.load_running_models, online_ollama))
+                models_list, models_error = models.result()
+                loaded_names = set().union(*loaded)
+                for model in models_list:
+                    model["loaded"] = model.get("name") in loaded_names
+
+        llamacpp_online = any(statuses[host] for host in self.llamacpp_hosts)
+        self.probe_finished.emit(bool(online_ollama), llamacpp_online, models_list, models_error)
+
+    def check_server_status(self, host):
+        import requests
 
         try:
-            with open(file_path, 'r') as file:
-                data = json.load(file)
+            response = SessionPool.get(f"http://{host}", timeout=self.timeout, retries=0)
+            return response.status_code == 200
+        except requests.RequestException:
+            return False
 
-            if isinstance(data, dict):
-                updated_data = self.update_json_structure(data, expected_structure)
+    def load_models_from_ollama(self, host):
+        """Return (models, error message) from Ollama's /api/tags."""
+        import requests
 
-                if updated_data != data:
-                    with open(file_path, 'w') as file:
-                        json.dump(updated_data, file, indent=4)
-            else:
-                raise json.JSONDecodeError("Invalid format", file_path, 0)
-
-        except json.JSONDecodeError:
-            self.rename_old_file(filename)
-            self.create_new_file_with_structure(filename, expected_structure)
-
-    def update_json_structure(self, data, expected_structure):
-        if not isinstance(data, dict) or not isinstance(expected_structure, dict):
-            return expected_structure
-
-        updated_data = data.copy()
-        for key, default_value in expected_structure.items():
-            if key not in updated_data:
-                updated_data[key] = default_value
-            elif isinstance(default_value, dict):
-                updated_data[key] = self.update_json_structure(updated_data[key], default_value)
-        return updated_data
-
-    def ensure_chat_files_are_up_to_date(self, expected_structure):
-        json_files = [f for f in os.listdir(os.getcwd()) if f.endswith('.json') and f != ConfigManager.CONFIG_FILENAME]
-        for file in json_files:
-            self.check_and_update_json_file(file, expected_structure)
-
-    def rename_old_file(self, filename):
-        old_file_path = os.path.join(os.getcwd(), filename)
-        new_file_path = os.path.join(os.getcwd(), f"OLD_{filename}")
-        if os.path.exists(old_file_path):
-            shutil.move(old_file_path, new_file_path)
-
-    def create_new_file_with_structure(self, filename, structure):
-        new_file_path = os.path.join(os.getcwd(), filename)
-        with open(new_file_path, 'w') as file:
-            json.dump(structure, file, indent=4)
-
-    def create_new_chat_file(self):
-        default_structure = {
-            "system_prompt": "",
-            "conversation_history": []
-        }
-        self.create_new_file_with_structure(self.chat_filename, default_structure)
+        try:
+            response = SessionPool.get(f"{self.baseurl}{host}/api/tags", timeout=self.timeout, retries=0)
+            response.raise_for_status()
+            return response.json().get("models", []), ""
+        except requests.RequestException as e:
+            return [], str(e)
 
-    def set_chat_filename(self, filename):
-        self.chat_filename = filename
+    def load_running_models(self, host):
+        """Return the names of the models Ollama currently holds in memory (/api/ps)."""
+        import requests
 
-    def get_next_available_filename(self):
-        index = 1
-        while True:
-            filename = f"chat_{index}.json"
-            if not os.path.exists(filename):
-                return filename
-            index += 1
+        try:
+            response = SessionPool.get(f"{self.baseurl}{host}/api/ps", timeout=self.timeout, retries=0)
+            response.raise_for_status()
+            return {model.get("name") for model in response.json().get("models", [])}
+        except (requests.RequestException, ValueError):
+            return set()
 
 
-class NetworkWorker(QThread):
-    response_received = pyqtSignal(str)
-    error_occurred = pyqtSignal(str)
+class ModelPreloadWorker(QThread):
+    """Asks Ollama to load a model into memory so the first message does not wait for it."""
+    preload_finished = pyqtSignal(str, str)
 
-    def __init__(self, conversation_history, endpoint, data, headers=None):
+    def __init__(self, endpoint, model, keep_alive):
         super().__init__()
-        self.conversation_history = conversation_history
         self.endpoint = endpoint
-        self.data = data
-        self.headers = headers if headers else {"Content-Type": "application/json"}
+        self.model = model
+        self.keep_alive = keep_alive
 
     def run(self):
+        import requests
+
         try:
-            response = requests.post(self.endpoint, headers=self.headers, json=self.data)
-            if response.status_code == 200:
-                bot_message = response.json()["choices"][0]["message"]["content"].strip()
-                self.response_received.emit(bot_message)
-            else:
-                self.error_occurred.emit(f"{response.status_code} - {response.text}")
+            # A chat request without messages only loads the model.
+            response = SessionPool.post(self.endpoint, json={"model": self.model, "messages": [], "keep_alive": self.keep_alive})
+            response.raise_for_status()
+            self.preload_finished.emit(self.model, "")
         except requests.RequestException as e:
-            self.error_occurred.emit(str(e))
+            self.preload_finished.emit(self.model, str(e))
+
+
+def wrap_message_html(html_content, role):
+    css_class = 'user-message' if role == "user" else 'bot-message'
+    return f"<div class='{css_class}'>{html_content}</div>"
+
+
+def placeholder_html(content, role):
+    """The message as plain grey text, shown until its Markdown has been rendered."""
+    return wrap_message_html(f"<span style='color: gray;'>{escape(content).replace(chr(10), '<br>')}</span>", role)
+
+
+class MarkdownRenderer(QObject):
+    """Renders message Markdown on a background thread.
+
+    markdown is pure Python, and a long reply with big tables or code blocks
+    takes long enough to freeze input and repaint. The GUI thread only
+    inserts the finished HTML, delivered through the rendered signal as
+    (render cache key, html).
+    """
+    rendered = pyqtSignal(str, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = set()
+
+    def submit(self, key, content, role):
+        if key not in self.pending:
+            self.pending.add(key)
+            self.executor.submit(self.render, key, content, role)
+
+    def finished(self, key):
+        self.pending.discard(key)
+
+    def busy(self):
+        return bool(self.pending)
+
+    def render(self, key, content, role):
+        try:
+            import markdown
+
+            html = wrap_message_html(markdown.markdown(content, extensions=['tables', 'fenced_code']), role)
+        except Exception:
+            logger.exception("Rendering a %s message failed", role)
+            html = placeholder_html(content, role)
+        self.rendered.emit(key, html)
 
 
 class OptionsDialog(QDialog):
@@ -268,7 +317,7 @@ class OptionsDialog(QDialog):
         self.clear_arguments_layout()
         if command == "/config":
             key_box = QComboBox()
-            key_box.addItems(["baseurl", "ollamahost", "llamacpphost", "path", "user_color", "assistant_color", "fontsize", "openaiapikey"])
+            key_box.addItems(["baseurl", "ollamahost", "llamacpphost", "path", "user_color", "assistant_color", "fontsize", "openaiapikey", "stream"])
             value_input = QLineEdit()
             value_input.setStyleSheet("background-color: #D3D3D3;")
             self.arguments_layout.addWidget(QLabel("Key:"))
@@ -337,6 +386,9 @@ class OptionsDialog(QDialog):
 
 
 class Chatbox(QWidget):
+    # Longest stretch spent adding messages to the display before yielding to the event loop.
+    DISPLAY_FRAME_SECONDS = 0.012
+
     def __init__(self):
         super().__init__()
         self.config = ConfigManager.load_config()
@@ -357,6 +409,10 @@ class Chatbox(QWidget):
 
         self.fontsize = int(self.config.get("fontsize", 18))
         self.conversation_history, self.system_prompt = self.chat_manager.load_chat_history()
+        self.chat_summary = self.chat_manager.load_summary(self.conversation_history)
+        self.summary_worker = None
+        # Bumped whenever a chat's history is thrown away, so summaries of the old turns are dropped.
+        self.chat_epochs = {}
         self.command_history = []
         self.command_index = -1
         self.is_moving = False
@@ -366,7 +422,32 @@ class Chatbox(QWidget):
         self.resize_direction = None
         self.oldPos = QPoint(0, 0)
         self.available_models = []
-        self.ollama_online, self.llamacpp_online = self.server_is_reachable()
+        self.stream_start = None
+        # Timings of the reply in progress, shown once it is complete.
+        self.last_timings = None
+        # Index of the oldest message currently rendered in chat_history.
+        self.display_start = 0
+        self.loading_earlier_messages = False
+        self.render_cache = RenderCache(int(self.config.get("render_cache_size", 2000)))
+        self.context_window = ContextWindow()
+        # None until the first background probe reports back.
+        self.ollama_online = None
+        self.llamacpp_online = None
+        self.probe_worker = None
+        self.catalog_worker = None
+        # Preload workers whose threads are still running.
+        self.preload_workers = set()
+        self.scheduler = RequestScheduler()
+        self.renderer = MarkdownRenderer(self)
+        self.renderer.rendered.connect(self.handle_rendered)
+        # Render cache key -> [[start, length, text] of each placeholder showing that message].
+        self.placeholders = {}
+        self.display_target = 0
+        self.display_fill_scheduled = False
+        # (key, html) of finished renders waiting to replace their placeholders.
+        self.rendered_queue = deque()
+        self.rendered_apply_scheduled = False
+        self.show_models_after_probe = False
 
         self.is_full_screen = False
 
@@ -377,13 +458,14 @@ class Chatbox(QWidget):
             "/select_model": self.select_model,
             "/resetmodel": self.reset_model,
             "/system_prompt": self.set_system_prompt,
+            "/search": self.search_chats,
+            "/stop": self.stop_generation,
+            "/stats": self.show_stats,
+            "/cache": self.manage_cache,
         }
 
         self.initUI()
 
-        if self.ollama_online:
-            self.load_models_from_ollama()
-
         self.load_chat_to_display()
 
         if not self.conversation_history:
@@ -393,6 +475,8 @@ class Chatbox(QWidget):
 
         self.restore_window_state()
 
+        self.refresh_backend_status()
+
     def ensure_chat_file_exists(self, filename):
         """Ensure the specified chat file exists or create it if it doesn't."""
         if not os.path.exists(filename):
@@ -474,7 +558,9 @@ class Chatbox(QWidget):
         elif event.key() == Qt.Key_Enter or event.key() == Qt.Key_Return:
             self.process_input()
         elif event.key() == Qt.Key_Escape:
-            if self.is_full_screen:
+            if self.scheduler.busy(self.chat_manager.chat_filename):
+                self.stop_generation()
+            elif self.is_full_screen:
                 self.exit_full_screen()
         elif event.key() == Qt.Key_F11:
             self.toggle_full_screen()
@@ -488,6 +574,7 @@ class Chatbox(QWidget):
         ConfigManager.save_config_value('selected_model', self.selected_model)
         ConfigManager.save_config_value('current_mode', self.mode)
         ConfigManager.save_config_value('current_chat_filename', self.chat_manager.chat_filename)
+        ConfigManager.flush()
 
         event.accept()
 
@@ -522,36 +609,40 @@ class Chatbox(QWidget):
         self.worker.error_occurred.connect(self.handle_error)
         self.worker.start()
 
-    def server_is_reachable(self):
-        ollama_online = self.check_server_status(self.config.get("ollamahost", "127.0.0.1:11434"))
-        llamacpp_online = self.check_server_status(self.config.get("llamacpphost", "127.0.0.1:8080"))
-        return ollama_online, llamacpp_online
-
-    def check_server_status(self, host):
-        try:
-            response = requests.get(f"http://{host}")
-            return response.status_code == 200
-        except requests.RequestException:
-            return False
+    def refresh_backend_status(self):
+        """Probe the backends in the background unless a probe is already running."""
+        if self.probe_worker is not None and self.probe_worker.isRunning():
+            return
+        self.probe_worker = BackendProbeWorker(self.config)
+        self.probe_worker.probe_finished.connect(self.handle_probe_finished)
+        self.probe_worker.start()
+
+    def handle_probe_finished(self, ollama_online, llamacpp_online, models, models_error):
+        self.ollama_online = ollama_online
+        self.llamacpp_online = llamacpp_online
+        self.available_models = models
+        if models_error:
+            self.chat_history.append(f"<b style='color: red;'>Error fetching models from Ollama: {models_error}</b>")
+
+        if self.help_message_displayed:
+            self.display_welcome_message()
+        elif self.show_models_after_probe:
+            self.display_models_list()
+        self.show_models_after_probe = False
 
-    def load_models_from_ollama(self):
-        try:
-            baseurl = self.config.get("baseurl", "http://")
-            host = self.config.get("ollamahost", "127.0.0.1:11434")
-            full_url = baseurl + host
-            response = requests.get(f"{full_url}/api/tags")
-            response.raise_for_status()
-            models_info = response.json()
-            self.available_models = models_info.get("models", [])
-        except requests.RequestException as e:
-            self.chat_history.append(f"<b style='color: red;'>Error fetching models from Ollama: {e}</b>")
+    def format_host_status(self, name, online, group):
+        if online is None:
+            return f"<b style='color: yellow;'>{name} host: Checking...</b>"
+        hosts = HostBalancer.parse_hosts(self.config.get(group, ""))
+        count = f" ({HostBalancer.count_online(hosts)} of {len(hosts)} hosts)" if len(hosts) > 1 else ""
+        return f"<b style='color: {'green' if online else 'red'};'>{name} host: {'Online' if online else 'Offline'}{count}</b>"
 
     def display_welcome_message(self):
-        ollama_status, llamacpp_status = self.server_is_reachable()
+        ollama_status, llamacpp_status = self.ollama_online, self.llamacpp_online
         openai_status = bool(self.config.get('openaiapikey'))
 
-        ollama_status_message = f"<b style='color: {'green' if ollama_status else 'red'};'>Ollama host: {'Online' if ollama_status else 'Offline'}</b>"
-        llamacpp_status_message = f"<b style='color: {'green' if llamacpp_status else 'red'};'>Llama.cpp host: {'Online' if llamacpp_status else 'Offline'}</b>"
+        ollama_status_message = self.format_host_status("Ollama", ollama_status, "ollamahost")
+        llamacpp_status_message = self.format_host_status("Llama.cpp", llamacpp_status, "llamacpphost")
         openai_status_message = f"<b style='color: {'green' if openai_status else 'red'};'>OpenAI: {'Configured' if openai_status else 'Not Configured'}</b>"
 
         welcome_message = f"""
@@ -603,7 +694,7 @@ class Chatbox(QWidget):
         command_key = parts[0]
 
         if command_key in self.commands:
-            if command_key in ["/config", "/select_model", "/system_prompt"]:
+            if command_key in ["/config", "/select_model", "/system_prompt", "/search"]:
                 if len(parts) >= 2:
                     self.commands[command_key](parts)
                 else:
@@ -648,8 +739,9 @@ class Chatbox(QWidget):
                 ConfigManager.save_config_value('selected_model', model_name)
                 ConfigManager.save_config_value('current_mode', self.mode)
                 self.chat_history.append(f"<b style='color: yellow;'>Provider: {provider.capitalize()}, Model: {model_name}</b>")
-                self.chat_history.clear()
                 self.load_chat_to_display()
+                if self.mode == 'ollama':
+                    self.preload_ollama_model(model_name)
             else:
                 self.display_error(f"Invalid model name: {model_name}. Please choose a valid model.")
         else:
@@ -664,7 +756,6 @@ class Chatbox(QWidget):
             self.mode = 'ollama'
 
         ConfigManager.save_config_value('current_mode', self.mode)
-        self.chat_history.clear()
         self.load_chat_to_display()
         self.chat_history.append(f"<b style='color: yellow;'>Mode switched to {self.mode}. Chat history loaded.</b>")
         self.display_welcome_message()
@@ -688,6 +779,8 @@ class Chatbox(QWidget):
         self.chat_history.setReadOnly(True)
         self.chat_history.setFont(QFont("Courier New", self.fontsize))
         self.chat_history.setStyleSheet(self.get_chat_style())
+        self.chat_history.document().setDefaultStyleSheet(self.get_document_style())
+        self.chat_history.verticalScrollBar().valueChanged.connect(self.handle_chat_scroll)
 
         self.chat_scroll_area = QScrollArea()
         self.chat_scroll_area.setWidgetResizable(True)
@@ -766,18 +859,196 @@ class Chatbox(QWidget):
         options_dialog.exec_()
 
     def load_chat_to_display(self):
+        """Show the most recent display_window messages; older pages load on scroll."""
+        # Reset the window first: clearing scrolls to the top, which would
+        # otherwise page in earlier messages from the old window.
+        window = int(self.config.get("display_window", 200))
+        self.display_start = len(self.conversation_history)
+        self.display_target = max(0, len(self.conversation_history) - window)
         self.chat_history.clear()
-        for message in self.conversation_history:
-            if message['role'] == 'user':
-                user_message_html = markdown.markdown(message['content'], extensions=['tables', 'fenced_code'])
-                user_message_html = self.apply_custom_css(user_message_html, role="user")
-                self.chat_history.append(user_message_html)
-            elif message['role'] == 'assistant':
-                assistant_message_html = markdown.markdown(message['content'], extensions=['tables', 'fenced_code'])
-                assistant_message_html = self.apply_custom_css(assistant_message_html, role="assistant")
-                self.chat_history.append(assistant_message_html)
+        self.placeholders = {}
+        self.attach_render_cache()
+        self.fill_display()
         self.chat_history.moveCursor(QTextCursor.End)
 
+    def fill_display(self):
+        """Prepend messages, newest first, until display_target is reached.
+
+        Each pass stops after DISPLAY_FRAME_SECONDS and the rest continues on
+        the next pass of the event loop, so opening a long chat never holds
+        up input or repaint for more than about a frame.
+        """
+        self.display_fill_scheduled = False
+        deadline = time.perf_counter() + self.DISPLAY_FRAME_SECONDS
+        document = self.chat_history.document()
+        scrollbar = self.chat_history.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum()
+        old_maximum, old_value = scrollbar.maximum(), scrollbar.value()
+        old_length = document.characterCount()
+
+        self.loading_earlier_messages = True
+        cursor = QTextCursor(document)
+        cursor.beginEditBlock()
+        while self.display_start > self.display_target and time.perf_counter() < deadline:
+            self.display_start -= 1
+            message = self.conversation_history[self.display_start]
+            if message['role'] not in ('user', 'assistant'):
+                continue
+            html, key = self.message_html(message['content'], message['role'])
+            cursor.movePosition(QTextCursor.Start)
+            empty = document.isEmpty()
+            cursor.insertHtml(html)
+            length = cursor.position()
+            if not empty:
+                cursor.insertBlock()
+            self.shift_display(0, document.characterCount() - old_length)
+            old_length = document.characterCount()
+            if key is not None:
+                self.track_placeholder(key, 0, length)
+        cursor.endEditBlock()
+
+        scrollbar.setValue(scrollbar.maximum() if at_bottom else old_value + scrollbar.maximum() - old_maximum)
+        self.loading_earlier_messages = False
+        if self.display_start > self.display_target and not self.display_fill_scheduled:
+            self.display_fill_scheduled = True
+            QTimer.singleShot(0, self.fill_display)
+
+    def display_busy(self):
+        """Whether messages are still being added to the display or rendered."""
+        return self.display_start > self.display_target or self.renderer.busy()
+
+    def handle_chat_scroll(self, value):
+        scrollbar = self.chat_history.verticalScrollBar()
+        if value == scrollbar.minimum() and self.display_start > 0 and not self.loading_earlier_messages:
+            self.load_earlier_messages()
+
+    def load_earlier_messages(self):
+        """Prepend the previous page of messages, keeping the visible text in place."""
+        if self.chat_history.document().blockCount() >= int(self.config.get("max_document_blocks", 5000)):
+            return
+        if self.display_start > self.display_target:
+            return
+        self.display_target = max(0, self.display_start - int(self.config.get("display_page_size", 50)))
+        self.fill_display()
+
+    def trim_display(self):
+        """Drop messages far above the viewport once the rendered window has grown too large."""
+        if self.stream_start is not None:
+            return
+        scrollbar = self.chat_history.verticalScrollBar()
+        if scrollbar.maximum() - scrollbar.value() > scrollbar.pageStep():
+            return
+        window = int(self.config.get("display_window", 200))
+        page_size = int(self.config.get("display_page_size", 50))
+        rendered = len(self.conversation_history) - self.display_start
+        too_many_blocks = self.chat_history.document().blockCount() > int(self.config.get("max_document_blocks", 5000))
+        if rendered > window + page_size or too_many_blocks:
+            self.load_chat_to_display()
+
+    def attach_render_cache(self):
+        if self.config.get("persist_render_cache"):
+            self.render_cache.attach(self.chat_manager.companion_path(".render.jsonl"))
+        else:
+            self.render_cache.attach(None)
+
+    def message_html(self, content, role):
+        """Return (html, key): the cached HTML and None, or a placeholder and the key it is being rendered under."""
+        key = RenderCache.make_key(content, role)
+        html = self.render_cache.get(key)
+        if html is not None:
+            return html, None
+        self.renderer.submit(key, content, role)
+        return placeholder_html(content, role), key
+
+    def append_message(self, content, role):
+        html, key = self.message_html(content, role)
+        document = self.chat_history.document()
+        # append() starts a new block unless the document is empty.
+        start = 0 if document.isEmpty() else document.characterCount()
+        self.chat_history.append(html)
+        if key is not None:
+            self.track_placeholder(key, start, document.characterCount() - 1)
+
+    def track_placeholder(self, key, start, end):
+        """Remember the placeholder text between start and end so handle_rendered can replace it."""
+        cursor = QTextCursor(self.chat_history.document())
+        cursor.setPosition(start)
+        cursor.setPosition(end, QTextCursor.KeepAnchor)
+        self.placeholders.setdefault(key, []).append([start, end - start, cursor.selectedText()])
+
+    def shift_display(self, position, delta):
+        """Move the placeholders and stream start at or after position by delta characters.
+
+        Appends at the end leave them alone, so only fill_display and
+        handle_rendered, which edit above the end, need to call this.
+        """
+        if not delta:
+            return
+        for targets in self.placeholders.values():
+            for target in targets:
+                if target[0] >= position:
+                    target[0] += delta
+        if self.stream_start is not None and self.stream_start >= position:
+            self.stream_start += delta
+
+    def handle_rendered(self, key, html):
+        """Cache a finished render and queue the swap for the placeholders waiting on it."""
+        self.render_cache.put(key, html)
+        self.rendered_queue.append((key, html))
+        if not self.rendered_apply_scheduled:
+            self.rendered_apply_scheduled = True
+            QTimer.singleShot(0, self.apply_rendered)
+
+    def apply_rendered(self):
+        """Swap finished renders in for their placeholders, one frame's worth per pass.
+
+        Opening a chat renders many messages in a row, and a reply repeated
+        throughout a chat has a placeholder for every copy, so the swaps are
+        budgeted like fill_display rather than done as each render arrives.
+        """
+        self.rendered_apply_scheduled = False
+        deadline = time.perf_counter() + self.DISPLAY_FRAME_SECONDS
+        document = self.chat_history.document()
+        scrollbar = self.chat_history.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum()
+        old_maximum, old_value = scrollbar.maximum(), scrollbar.value()
+        top = self.chat_history.cursorForPosition(QPoint(0, 0)).position()
+        above_view = False
+        cursor = QTextCursor(document)
+        while self.rendered_queue and time.perf_counter() < deadline:
+            key, html = self.rendered_queue[0]
+            targets = self.placeholders.get(key)
+            if not targets:
+                self.rendered_queue.popleft()
+                self.placeholders.pop(key, None)
+                self.renderer.finished(key)
+                continue
+            start, length, text = targets.pop()
+            if start + length >= document.characterCount():
+                continue
+            cursor.setPosition(start)
+            cursor.setPosition(start + length, QTextCursor.KeepAnchor)
+            if cursor.selectedText() != text:
+                # The display was rebuilt after the placeholder went in.
+                continue
+            old_length = document.characterCount()
+            cursor.insertHtml(html)
+            delta = document.characterCount() - old_length
+            self.shift_display(start + length, delta)
+            if start < top:
+                above_view = True
+                top += delta
+        self.render_cache.save()
+
+        if at_bottom:
+            scrollbar.setValue(scrollbar.maximum())
+        elif above_view:
+            # Keep the visible text in place when a message above it changes height.
+            scrollbar.setValue(old_value + scrollbar.maximum() - old_maximum)
+        if self.rendered_queue and not self.rendered_apply_scheduled:
+            self.rendered_apply_scheduled = True
+            QTimer.singleShot(0, self.apply_rendered)
+
     def update_config(self, parts):
         if len(parts) >= 3:
             key = parts[1]
@@ -801,9 +1072,18 @@ class Chatbox(QWidget):
                         return
                     self.fontsize = value
                     self.update_fontsizes()
+                elif isinstance(ConfigManager.DEFAULT_CONFIG.get(key), bool):
+                    value = value.lower() in ("1", "true", "yes", "on")
+                elif key in ("ollamahost", "llamacpphost"):
+                    hosts = HostBalancer.parse_hosts(value)
+                    value = hosts if len(hosts) > 1 else value
 
                 ConfigManager.save_config_value(key, value)
                 self.config[key] = value
+                if key in ("user_color", "assistant_color"):
+                    self.apply_theme()
+                elif key in ("ollamahost", "llamacpphost"):
+                    self.refresh_backend_status()
                 self.chat_history.append(f"<b style='color: yellow;'>Config updated: {key} = {value}</b>")
             else:
                 self.display_error(f"Invalid configuration key: {key}")
@@ -817,6 +1097,7 @@ class Chatbox(QWidget):
 
             if action == "new":
                 self.chat_manager.chat_filename = filename
+                self.forget_chat_state(filename)
                 self.system_prompt = ""
                 self.chat_manager.save_chat_history([], self.system_prompt)
                 self.open_chat(filename)
@@ -824,20 +1105,28 @@ class Chatbox(QWidget):
             elif action == "save":
                 self.chat_manager.chat_filename = filename
                 self.chat_manager.save_chat_history(self.conversation_history, self.system_prompt)
+                if self.chat_summary:
+                    self.chat_manager.save_summary(self.chat_summary)
                 self.chat_history.append(f"<b style='color: yellow;'>Chat saved as {filename}.</b>")
             elif action == "delete":
                 self.chat_manager.set_chat_filename(filename)
                 chat_history_path = os.path.join(os.getcwd(), self.chat_manager.chat_filename)
                 if os.path.exists(chat_history_path):
+                    self.scheduler.cancel(filename)
+                    self.render_cache.attach(None)
                     os.remove(chat_history_path)
+                    self.chat_manager.delete_companion_files(filename)
+                    ChatCatalog.record_delete(filename)
                     self.chat_history.append(f"<b style='color: yellow;'>Chat file {filename} deleted.</b>")
                 else:
                     self.display_error(f"Chat file {filename} does not exist.")
             elif action == "reset":
                 self.reset_chat()
-            elif action == "rename" and len(parts) == 4:
-                old_filename = self.ensure_json_extension(parts[2])
-                new_filename = self.ensure_json_extension(parts[3])
+            elif action == "rename" and len(parts[2].split()) == 2:
+                # execute_command splits at most twice, so both names arrive in parts[2].
+                old_name, new_name = parts[2].split()
+                old_filename = self.ensure_json_extension(old_name)
+                new_filename = self.ensure_json_extension(new_name)
                 self.rename_chat_file(old_filename, new_filename)
             elif action == "open":
                 self.open_chat(filename)
@@ -863,34 +1152,124 @@ class Chatbox(QWidget):
             return
 
         try:
+            self.render_cache.attach(None)
             shutil.move(old_path, new_path)
+            self.chat_manager.move_companion_files(old_filename, new_filename)
+            ChatCatalog.record_rename(old_filename, new_filename)
+            self.scheduler.rename(old_filename, new_filename)
             self.chat_manager.set_chat_filename(new_filename)
+            self.attach_render_cache()
             self.chat_history.append(f"<b style='color: yellow;'>Chat file renamed to {new_filename}.</b>")
         except Exception as e:
             self.display_error(f"Failed to rename chat file: {str(e)}")
 
     def list_chat_files(self):
-        json_files = [f for f in os.listdir(os.getcwd()) if f.endswith('.json') and f != 'config.json']
+        # A first-run refresh reads and indexes every chat, so list once it is done.
+        if self.catalog_worker is not None and self.catalog_worker.isRunning():
+            return
+        self.catalog_worker = CatalogRefreshWorker()
+        self.catalog_worker.refreshed.connect(self.show_chat_files)
+        self.catalog_worker.start()
+
+    def show_chat_files(self, entries):
         self.chat_history.append("<b style='color: yellow;'>Available chat files:</b>")
-        for file in json_files:
-            self.chat_history.append(f"<b style='color: green;'>{file}</b>")
+        for file in sorted(entries):
+            entry = entries[file]
+            title = escape(entry["title"]) if entry["title"] else "untitled"
+            self.chat_history.append(f"<b style='color: green;'>{file}</b> ({entry['message_count']} messages) {title}")
+        self.chat_history.moveCursor(QTextCursor.End)
+
+    def search_chats(self, parts):
+        query = " ".join(parts[1:])
+        if not SearchIndex.available():
+            self.display_error("Search is unavailable: this Python's SQLite has no FTS5 support.")
+            return
+
+        started = time.perf_counter()
+        hits = SearchIndex.search(query)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        self.chat_history.append(f"<b style='color: yellow;'>{len(hits)} matches for '{escape(query)}' ({elapsed_ms:.1f} ms):</b>")
+        for chat, position, role, snippet in hits:
+            snippet = escape(snippet.replace("\n", " "))
+            snippet = snippet.replace(SearchIndex.SNIPPET_OPEN, "<b>").replace(SearchIndex.SNIPPET_CLOSE, "</b>")
+            self.chat_history.append(f"<span style='color: green;'>{chat} #{position} ({role}):</span> {snippet}")
+        if hits:
+            self.chat_history.append("<b style='color: yellow;'>Use /chat open &lt;filename&gt; to open a chat.</b>")
+        self.chat_history.moveCursor(QTextCursor.End)
+
+    def show_stats(self, parts):
+        """Latency and throughput percentiles per backend/model and per host from MetricsStore."""
+        records = MetricsStore.load()
+        if not records:
+            self.chat_history.append("<b style='color: yellow;'>No requests recorded yet.</b>")
+            return
+
+        def fmt(values, unit):
+            return "/".join("-" if v is None else f"{v:.0f}" if unit == "ms" else f"{v:.1f}" for v in values) + f" {unit}"
+
+        percentiles = "/".join(f"p{p}" for p in MetricsStore.PERCENTILES)
+        self.chat_history.append(f"<b style='color: yellow;'>Request stats over {len(records)} requests ({percentiles}):</b>")
+        sections = [
+            ("By backend and model", lambda r: f"{r.get('backend')} {r.get('model')}"),
+            ("By host", lambda r: f"{r.get('backend')} {r.get('host')}")
+        ]
+        for title, key in sections:
+            self.chat_history.append(f"<b style='color: yellow;'>{title}:</b>")
+            for group, stats in sorted(MetricsStore.summarize(records, key).items()):
+                self.chat_history.append(
+                    f"<span style='color: green;'>{escape(group)}</span>: {stats['count']} requests, {stats['errors']} errors"
+                    f" | queue {fmt(stats['queue_ms'], 'ms')} | headers {fmt(stats['headers_ms'], 'ms')} | first token {fmt(stats['ttft_ms'], 'ms')}"
+                    f" | total {fmt(stats['total_ms'], 'ms')} | {fmt(stats['tokens_per_s'], 'tokens/s')}")
+        self.chat_history.moveCursor(QTextCursor.End)
+
+    def manage_cache(self, parts):
+        """Show the response cache's size and hit rate, or empty it with /cache clear."""
+        if len(parts) > 1 and parts[1] == "clear":
+            ResponseCache.clear()
+            self.chat_history.append("<b style='color: yellow;'>Response cache cleared.</b>")
+            return
+        stats = ResponseCache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = f"{stats['hits'] * 100 / lookups:.0f}%" if lookups else "-"
+        state = "on" if self.config.get("response_cache") else "off"
+        self.chat_history.append(
+            f"<b style='color: yellow;'>Response cache ({state}):</b> {stats['entries']} replies, {stats['bytes'] / 1024:.0f} KB"
+            f" | {stats['hits']} hits, {stats['misses']} misses ({hit_rate})")
         self.chat_history.moveCursor(QTextCursor.End)
 
     def reset_chat(self):
+        self.scheduler.cancel(self.chat_manager.chat_filename)
+        self.stream_start = None
         self.conversation_history = []
         self.system_prompt = ""
+        self.chat_summary = None
+        self.forget_chat_state(self.chat_manager.chat_filename)
+        self.display_start = self.display_target = 0
+        self.placeholders = {}
         self.chat_history.clear()
         self.chat_manager.save_chat_history(self.conversation_history, self.system_prompt)
         self.chat_history.append(f"<b style='color: yellow;'>Chat history has been reset.</b>")
         self.chat_history.moveCursor(QTextCursor.End)
 
+    def forget_chat_state(self, chat_filename):
+        """Drop what was derived from a chat's old history when it is reset or recreated."""
+        self.chat_epochs[chat_filename] = self.chat_epochs.get(chat_filename, 0) + 1
+        self.context_window.forget(chat_filename)
+        summary_path = self.chat_manager.companion_path(".summary.jsonl", chat_filename)
+        if os.path.exists(summary_path):
+            os.remove(summary_path)
+
     def open_chat(self, chat_filename):
         self.chat_manager.chat_filename = chat_filename
         self.conversation_history, self.system_prompt = self.chat_manager.load_chat_history()
-        self.chat_history.clear()
+        self.chat_summary = self.chat_manager.load_summary(self.conversation_history)
+        self.context_window.forget(chat_filename)
+        self.stream_start = None
         self.load_chat_to_display()
         self.chat_history.append(f"<b style='color: yellow;'>Chat {chat_filename} opened.</b>")
         ConfigManager.save_config_value('current_chat_filename', chat_filename)
+        self.dispatch_queued()
 
     def ensure_json_extension(self, filename):
         if not filename.endswith('.json'):
@@ -911,138 +1290,339 @@ class Chatbox(QWidget):
         self.setStyleSheet(self.get_global_style())
 
     def send_message(self, user_message):
-        user_message_html = markdown.markdown(user_message, extensions=['tables', 'fenced_code'])
-        user_message_html = self.apply_custom_css(user_message_html, role="user")
+        chat_filename = self.chat_manager.chat_filename
+        if self.scheduler.busy(chat_filename):
+            waiting = self.scheduler.enqueue(chat_filename, user_message)
+            self.chat_history.append(f"<span style='color: gray;'>Queued ({waiting} waiting): {escape(user_message)}</span>")
+            self.chat_history.moveCursor(QTextCursor.End)
+            return
+        self.dispatch_message(user_message)
 
-        self.chat_history.append(user_message_html)
+    def dispatch_message(self, user_message, queued_at=None):
+        self.append_message(user_message, "user")
         self.chat_history.moveCursor(QTextCursor.End)
 
         self.conversation_history.append({"role": "user", "content": user_message})
         self.chat_manager.save_chat_history(self.conversation_history, self.system_prompt)
 
-        baseurl = self.config['baseurl']
-        path = self.config['path']
-
-        system_prompt = {"role": "system", "content": self.system_prompt if self.system_prompt else "You are a helpful assistant."}
+        messages = build_messages(self.config, self.mode, self.selected_model, self.system_prompt, self.conversation_history,
+                                  self.context_window, self.active_summary(), anchor_key=self.chat_manager.chat_filename)
 
-        if self.mode == 'ollama':
-            full_endpoint = f"{baseurl}{self.config['ollamahost']}{path}"
-            data = {
-                "model": self.selected_model,
-                "messages": [system_prompt] + self.conversation_history
-            }
-        elif self.mode == 'llama.cpp':
-            full_endpoint = f"{baseurl}{self.config['llamacpphost']}{path}"
-            data = {
-                "messages": [system_prompt] + self.conversation_history
-            }
-        elif self.mode == 'openai':
-            openai_url = "https://api.openai.com/v1/chat/completions"
-            api_key = self.config.get('openaiapikey')
-            if not api_key:
-                self.handle_error("OpenAI API key is not set. Please update your configuration.")
-                return
-
-            if not self.selected_model:
-                self.selected_model = "gpt-4o"
-
-            full_endpoint = openai_url
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}"
-            }
-            data = {
-                "model": self.selected_model,
-                "messages": [system_prompt] + self.conversation_history
-            }
-        else:
-            self.handle_error("Invalid mode selected. Please check your configuration.")
+        # No worker is started on these early returns, so handle_worker_finished
+        # will not move the queue on; do it here.
+        request = self.build_request(messages)
+        if request is None:
+            self.dispatch_queued()
             return
+        full_endpoint, data, headers, protocol, route = request
 
-        headers = headers if self.mode == 'openai' else {"Content-Type": "application/json"}
+        cache_key = ResponseCache.key_for(self.config, self.mode, data)
+        cached = ResponseCache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            self.show_cached_reply(cached[0])
+            self.dispatch_queued()
+            return
 
-        self.worker = NetworkWorker(self.conversation_history, full_endpoint, data, headers)
+        stream = bool(self.config.get('stream', True))
+        self.worker = NetworkWorker(self.conversation_history, full_endpoint, data, headers, stream=stream, protocol=protocol, route=route)
+        self.worker.request.metrics_tags = self.metrics_tags(data, "chat")
+        self.worker.request.cache_key = cache_key
+        if queued_at is not None:
+            self.worker.request.queued_at = queued_at
+        self.worker.token_received.connect(self.handle_token)
+        self.worker.timings_received.connect(self.handle_timings)
         self.worker.response_received.connect(self.handle_response)
-        self.worker.error_occurred.connect(self.handle_error)
-        self.worker.start()
+        self.worker.error_occurred.connect(self.handle_generation_error)
+        self.worker.finished.connect(self.handle_worker_finished)
+        self.scheduler.start(self.chat_manager.chat_filename, self.worker)
+
+    def stop_generation(self, parts=None):
+        """Cancel the open chat's running generation (Esc or /stop) and drop its queued messages."""
+        worker, dropped = self.scheduler.cancel(self.chat_manager.chat_filename)
+        if worker is None and not dropped:
+            self.chat_history.append("<b style='color: yellow;'>Nothing to stop.</b>")
+            return
+
+        self.stream_start = None
+        if worker:
+            self.chat_manager.save_partial_reply(self.conversation_history, self.system_prompt, worker.request.partial_text())
+        notice = "Generation stopped." if worker else "Queue cleared."
+        if dropped:
+            notice += f" {dropped} queued message{'s' if dropped != 1 else ''} dropped."
+        self.chat_history.append(f"<b style='color: yellow;'>{notice}</b>")
+        self.chat_history.moveCursor(QTextCursor.End)
+
+    def handle_worker_finished(self):
+        worker = self.sender()
+        worker.wait()
+        self.scheduler.finish(worker)
+        self.dispatch_queued()
+
+    def dispatch_queued(self):
+        chat_filename = self.chat_manager.chat_filename
+        if not self.scheduler.busy(chat_filename):
+            entry = self.scheduler.next_message(chat_filename)
+            if entry is not None:
+                self.dispatch_message(*entry)
+
+    def save_background_reply(self, chat_filename, response):
+        """Append a reply to a chat that is no longer the open one."""
+        manager = ChatHistoryManager(chat_filename)
+        history, system_prompt = manager.load_chat_history()
+        history.append({"role": "assistant", "content": response})
+        manager.save_chat_history(history, system_prompt)
+        # save_chat_history marks the chat it wrote as current; keep the open one.
+        ConfigManager.save_config_value('current_chat_filename', self.chat_manager.chat_filename)
+        self.chat_history.append(f"<span style='color: gray;'>Reply for {chat_filename} saved.</span>")
+
+    def active_summary(self):
+        return self.chat_summary if self.config.get("summarize") else None
+
+    def build_request(self, messages, pin_slot=True):
+        """Return (endpoint, data, headers, protocol, route) for the current mode, or None after reporting an error."""
+        if self.mode == 'openai' and not self.selected_model:
+            self.selected_model = "gpt-4o"
+        try:
+            return build_chat_request(self.config, self.mode, self.selected_model, messages, self.chat_manager.chat_filename,
+                                      pin_slot=pin_slot)
+        except ValueError as e:
+            self.handle_error(str(e))
+            return None
+
+    def metrics_tags(self, data, kind):
+        return {"backend": self.mode, "model": data.get("model") or "(server default)", "kind": kind}
+
+    def pick_host(self, group):
+        return pick_host(self.config, group, self.chat_manager.chat_filename)
+
+    def preload_ollama_model(self, model_name):
+        """Load the selected Ollama model in the background so it is warm for the first message."""
+        host = self.pick_host('ollamahost')
+        if host is None:
+            return
+        endpoint = f"{self.config['baseurl']}{host}/api/chat"
+        worker = ModelPreloadWorker(endpoint, model_name, self.config.get("ollama_keep_alive", "30m"))
+        worker.preload_finished.connect(self.handle_model_preloaded)
+        worker.finished.connect(self.handle_preload_worker_finished)
+        # Switching models again before this one is loaded must not destroy a running thread.
+        self.preload_workers.add(worker)
+        worker.start()
+
+    def handle_preload_worker_finished(self):
+        self.preload_workers.discard(self.sender())
+
+    def handle_model_preloaded(self, model_name, error):
+        if error:
+            self.display_error(f"Could not preload {model_name}: {error}")
+            return
+        for model in self.available_models:
+            if model.get("name") == model_name:
+                model["loaded"] = True
+        self.chat_history.append(f"<span style='color: gray;'>{model_name} is loaded and ready.</span>")
+
+    def maybe_summarize(self):
+        """Start compacting the oldest unsummarized turns once they outgrow summary_trigger_tokens."""
+        if not self.config.get("summarize") or (self.summary_worker is not None and self.summary_worker.isRunning()):
+            return
+
+        covered = self.chat_summary["covered"] if self.chat_summary else 0
+        keep = int(self.config.get("summary_keep_messages", 6))
+        candidates = self.conversation_history[covered:len(self.conversation_history) - keep]
+        pending_tokens = sum(self.context_window.estimate_tokens(message) for message in self.conversation_history[covered:])
+        if not candidates or pending_tokens < int(self.config.get("summary_trigger_tokens", 4096)):
+            return
+
+        block_tokens = int(self.config.get("summary_block_tokens", 2048))
+        block = []
+        for message in candidates:
+            block.append(message)
+            block_tokens -= self.context_window.estimate_tokens(message)
+            if block_tokens <= 0:
+                break
+
+        transcript = "\n\n".join(f"{message['role'].capitalize()}: {message['content']}" for message in block)
+        previous = self.chat_summary["summary"] if self.chat_summary else "(none)"
+        messages = [
+            {"role": "system", "content": "You maintain a running summary of a conversation. Keep every fact, decision, name and open question that later turns may rely on. Reply with the summary only."},
+            {"role": "user", "content": f"Current summary:\n{previous}\n\nNew turns to fold in:\n{transcript}\n\nWrite the updated summary."}
+        ]
+        # The summary prompt shares nothing with the chat's, so keep it off the chat's KV cache slot.
+        request = self.build_request(messages, pin_slot=False)
+        if request is None:
+            return
+        endpoint, data, headers, protocol, route = request
+
+        chat_filename = self.chat_manager.chat_filename
+        epoch = self.chat_epochs.get(chat_filename, 0)
+        new_covered = covered + len(block)
+        self.summary_worker = NetworkWorker(self.conversation_history, endpoint, data, headers, protocol=protocol, route=route)
+        self.summary_worker.request.metrics_tags = self.metrics_tags(data, "summary")
+        self.summary_worker.response_received.connect(lambda summary: self.handle_summary(chat_filename, epoch, new_covered, summary))
+        self.summary_worker.error_occurred.connect(lambda error: self.handle_error(f"Summarization failed: {error}"))
+        self.summary_worker.start()
+
+    def handle_summary(self, chat_filename, epoch, covered, summary):
+        if epoch != self.chat_epochs.get(chat_filename, 0):
+            # The chat was reset or recreated while this summary was being written.
+            return
+        is_open = chat_filename == self.chat_manager.chat_filename
+        if is_open and covered > len(self.conversation_history):
+            return
+        summary_record = {"covered": covered, "summary": summary}
+        ChatHistoryManager(chat_filename).save_summary(summary_record)
+        if is_open:
+            self.chat_summary = summary_record
+            self.maybe_summarize()
+
+    def is_displayed(self, worker):
+        """Whether worker is the running generation of the chat on screen."""
+        return self.scheduler.is_active(worker) and worker.chat_filename == self.chat_manager.chat_filename
+
+    def handle_token(self, token):
+        """Append a streamed token as plain text to the current assistant block."""
+        if not self.is_displayed(self.sender()):
+            return
+        cursor = self.chat_history.textCursor()
+        if self.stream_start is None:
+            self.chat_history.append("")
+            cursor.movePosition(QTextCursor.End)
+            self.stream_start = cursor.position()
+
+        token_format = QTextCharFormat()
+        token_format.setForeground(QColor(self.config['assistant_color']))
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(token, token_format)
+        self.chat_history.moveCursor(QTextCursor.End)
 
     def handle_response(self, response):
+        worker = self.sender()
+        if not self.scheduler.is_active(worker):
+            return
+        if worker.chat_filename != self.chat_manager.chat_filename:
+            self.save_background_reply(worker.chat_filename, response)
+            return
+
+        self.show_reply(response)
+
+    def show_reply(self, response):
+        """Add a finished assistant reply to the open chat, save it and render it."""
         self.conversation_history.append({"role": "assistant", "content": response})
         self.chat_manager.save_chat_history(self.conversation_history, self.system_prompt)
 
-        response_html = markdown.markdown(response, extensions=['tables', 'fenced_code'])
-        response_html = self.apply_custom_css(response_html, role="assistant")
-        self.chat_history.append(response_html)
+        if self.stream_start is not None:
+            html, key = self.message_html(response, "assistant")
+            end = self.chat_history.document().characterCount() - 1
+            if key is None:
+                # Swap the streamed plain text for the rendered Markdown.
+                cursor = self.chat_history.textCursor()
+                cursor.setPosition(self.stream_start)
+                cursor.setPosition(end, QTextCursor.KeepAnchor)
+                cursor.insertHtml(html)
+            else:
+                # The streamed text stays up as the placeholder until the render is done.
+                self.track_placeholder(key, self.stream_start, end)
+            self.stream_start = None
+        else:
+            self.append_message(response, "assistant")
 
+        self.display_timings()
+        self.chat_history.moveCursor(QTextCursor.End)
+        self.trim_display()
+        self.maybe_summarize()
+
+    def show_cached_reply(self, response):
+        self.stream_start = None
+        # The stored timings belong to the original generation, not to this reply.
+        self.last_timings = None
+        self.show_reply(response)
+        self.chat_history.append("<span style='color: gray;'>(cached reply)</span>")
         self.chat_history.moveCursor(QTextCursor.End)
 
+    def handle_timings(self, timings):
+        if self.is_displayed(self.sender()):
+            self.last_timings = timings
+
+    def display_timings(self):
+        """Show the backend's prompt-eval and generation timings for the reply that just finished."""
+        timings, self.last_timings = self.last_timings, None
+        if not timings or not self.config.get("show_timings", True):
+            return
+        load = f"model load: {timings['load_ms']:.0f} ms | " if timings.get("load_ms", 0) >= 1 else ""
+        prompt = f"{load}prompt eval: {timings.get('prompt_n', 0)} tokens in {timings.get('prompt_ms', 0):.0f} ms"
+        if "cache_n" in timings:
+            prompt += f" ({timings['cache_n']} reused from cache)"
+        predicted_n, predicted_ms = timings.get('predicted_n', 0), timings.get('predicted_ms', 0)
+        tokens_per_second = timings.get('predicted_per_second') or (predicted_n * 1000 / predicted_ms if predicted_ms else 0)
+        generation = f"generation: {predicted_n} tokens at {tokens_per_second:.1f} tokens/s"
+        self.chat_history.append(f"<span style='color: gray;'>{prompt} | {generation}</span>")
+
+    def handle_generation_error(self, error_message):
+        worker = self.sender()
+        if not self.scheduler.is_active(worker):
+            return
+        if worker.chat_filename != self.chat_manager.chat_filename:
+            error_message = f"{worker.chat_filename}: {error_message}"
+        self.handle_error(error_message)
+
     def handle_error(self, error_message):
+        self.stream_start = None
         self.chat_history.append(f"<b style='color: red;'>Error:</b> {error_message}")
 
-    def apply_custom_css(self, html_content, role):
-        custom_css = """
-        <style>
-            .user-message, .bot-message {
+    def get_document_style(self):
+        """Stylesheet shared by every message in chat_history, selected by role class."""
+        return f"""
+            .user-message, .bot-message {{
                 margin: 1px 0;
                 padding: 0;
                 line-height: 1.1;
                 margin-bottom: 1px;
-            }
-            pre, code {
+                font-family: 'Courier New';
+                background-color: #000000;
+            }}
+            .user-message {{
+                color: {self.config['user_color']};
+            }}
+            .bot-message {{
+                color: {self.config['assistant_color']};
+            }}
+            pre, code {{
                 background-color: #333333;
                 border-radius: 4px;
                 padding: 2px;
                 margin: 0;
-            }
-            table {
+            }}
+            table {{
                 width: 100%;
-                border-collapse: collapse.
-            }
-            th, td {
-                border: 1px solid.
+                border-collapse: collapse;
+            }}
+            th, td {{
+                border: 1px solid;
                 padding: 2px;
-            }
-            blockquote {
+            }}
+            blockquote {{
                 border-left: 4px solid;
                 margin: 3px 0;
                 padding-left: 10px;
                 background-color: #222222;
-            }
-        </style>
+            }}
+            .user-message blockquote {{
+                color: {self.config['user_color']};
+                border-color: {self.config['user_color']};
+            }}
+            .bot-message blockquote {{
+                color: {self.config['assistant_color']};
+                border-color: {self.config['assistant_color']};
+            }}
         """
-        if role == "user":
-            custom_css += f"""
-            <style>
-                .user-message {{
-                    color: {self.config['user_color']};
-                    font-family: 'Courier New';
-                    background-color: #000000;
-                }}
-                blockquote {{
-                    color: {self.config['user_color']};
-                    border-color: {self.config['user_color']};
-                }}
-            </style>
-            """
-            return f"{custom_css}<div class='user-message'>{html_content}</div>"
-        else:
-            custom_css += f"""
-            <style>
-                .bot-message {{
-                    color: {self.config['assistant_color']};
-                    font-family: 'Courier New';
-                    background-color: #000000;
-                }}
-                blockquote {{
-                    color: {self.config['assistant_color']};
-                    border-color: {self.config['assistant_color']};
-                }}
-            </style>
-            """
-            return f"{custom_css}<div class='bot-message'>{html_content}</div>"
+
+    def apply_theme(self):
+        """Restyle the chat after a colour change, reusing the cached message HTML."""
+        self.chat_history.document().setDefaultStyleSheet(self.get_document_style())
+        self.update_fontsizes()
+        self.load_chat_to_display()
 
     def display_models_list(self):
-        ollama_status, _ = self.server_is_reachable()
+        ollama_status = self.ollama_online
         openai_status = bool(self.config.get('openaiapikey'))
 
         if openai_status:
@@ -1056,7 +1636,8 @@ class Chatbox(QWidget):
             if self.available_models:
                 self.chat_history.append("<b style='color: yellow;'>Available models from Ollama:</b>")
                 for model in self.available_models:
-                    self.chat_history.append(f"<b style='color: green;'>/select_model ollama {model['name']}</b>")
+                    loaded = " <span style='color: gray;'>(loaded)</span>" if model.get("loaded") else ""
+                    self.chat_history.append(f"<b style='color: green;'>/select_model ollama {model['name']}</b>{loaded}")
                 self.chat_history.append("<b style='color: yellow;'>Copy and paste a command to select a model and press enter.</b>")
             else:
                 self.chat_history.append("<b style='color: yellow;'>No available models found from Ollama.</b>")
@@ -1064,24 +1645,37 @@ class Chatbox(QWidget):
         self.chat_history.moveCursor(QTextCursor.End)
 
     def list_models(self, parts):
-        self.display_models_list()
+        self.chat_history.append("<b style='color: yellow;'>Checking backends...</b>")
+        self.show_models_after_probe = True
+        self.refresh_backend_status()
 
 
-if __name__ == "__main__":
-    config = ConfigManager.load_config()
+def finish_startup(profile_startup):
+    StartupProfiler.mark("first event loop pass")
+    if profile_startup:
+        StartupProfiler.report()
+        QApplication.quit()
+        return
+    # Only chats changed since the last run are re-read (and migrated if needed);
+    # the first run also builds the search index, so keep it off the GUI thread.
+    threading.Thread(target=ChatCatalog.refresh, daemon=True).start()
 
-    expected_chat_structure = {
-        "system_prompt": "",
-        "conversation_history": []
-    }
 
-    chat_manager = ChatHistoryManager()
-    chat_manager.ensure_chat_files_are_up_to_date(expected_chat_structure)
+if __name__ == "__main__":
+    profile_startup = "--profile-startup" in sys.argv
+
+    config = ConfigManager.load_config()
+    configure_logging(config)
+    StartupProfiler.mark("config")
 
     app = QApplication([])
+    StartupProfiler.mark("QApplication")
 
     chatbox = Chatbox()
+    StartupProfiler.mark("Chatbox")
     set_amoled_black_title_bar(chatbox)
     chatbox.show()
+    StartupProfiler.mark("show")
 
+    QTimer.singleShot(0, lambda: finish_startup(profile_startup))
     sys.exit(app.exec_())
@@ -0,0 +1,411 @@
+"""Terminal front end for Retrochat.
+
+Uses the same config.json, chat files and backend code as the GUI, but never
+imports PyQt5, so it runs on headless machines and answers a one-shot question
+without paying for QApplication startup.
+
+    python retrochat_cli.py "What is a Z80?"     one-shot, reply streamed to stdout
+    echo "Hi" | python retrochat_cli.py           one-shot from stdin
+    python retrochat_cli.py                       interactive prompt
+    python retrochat_cli.py --batch prompts.jsonl batch run, results to prompts.results.jsonl
+"""
+import os
+import sys
+import json
+import queue
+import argparse
+import threading
+
+from retrochat_core import (ConfigManager, ChatHistoryManager, ContextWindow, ChatRequest, HostBalancer, ResponseCache,
+                            build_messages, build_chat_request, configure_logging)
+
+MODES = ["ollama", "llama.cpp", "openai"]
+
+
+class ChatSession:
+    """One chat file and the backend settings used to continue it."""
+
+    def __init__(self, config, mode, model, chat_filename, stream):
+        self.config = config
+        self.mode = mode
+        self.model = model
+        self.stream = stream
+        self.context_window = ContextWindow()
+        self.chat_manager = ChatHistoryManager(chat_filename=chat_filename)
+        self.open_chat(chat_filename)
+
+    def open_chat(self, chat_filename):
+        self.chat_manager.chat_filename = chat_filename
+        self.conversation_history, self.system_prompt = self.chat_manager.load_chat_history()
+        self.chat_summary = self.chat_manager.load_summary(self.conversation_history)
+        self.context_window.forget(chat_filename)
+
+    def active_summary(self):
+        return self.chat_summary if self.config.get("summarize") else None
+
+    def send(self, user_message):
+        """Send user_message, stream the reply to stdout and save both; return False on error."""
+        self.conversation_history.append({"role": "user", "content": user_message})
+        self.chat_manager.save_chat_history(self.conversation_history, self.system_prompt)
+
+        messages = build_messages(self.config, self.mode, self.model, self.system_prompt, self.conversation_history,
+                                  self.context_window, self.active_summary(), anchor_key=self.chat_manager.chat_filename)
+        try:
+            endpoint, data, headers, protocol, route = build_chat_request(
+                self.config, self.mode, self.model, messages, self.chat_manager.chat_filename)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            return False
+
+        cache_key = ResponseCache.key_for(self.config, self.mode, data)
+        cached = ResponseCache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            print(cached[0])
+            self.conversation_history.append({"role": "assistant", "content": cached[0]})
+            self.chat_manager.save_chat_history(self.conversation_history, self.system_prompt)
+            return True
+
+        request = ChatRequest(endpoint, data, headers, stream=self.stream, protocol=protocol, route=route)
+        request.metrics_tags = {"backend": self.mode, "model": data.get("model") or "(server default)", "kind": "cli"}
+        request.cache_key = cache_key
+        result = {}
+        request.on_token = self.write_token
+        request.on_response = lambda text: result.setdefault("response", text)
+        request.on_error = lambda message: result.setdefault("error", message)
+
+        thread = threading.Thread(target=request.run, daemon=True)
+        thread.start()
+        try:
+            join_interruptibly(thread)
+        except KeyboardInterrupt:
+            request.cancel()
+            thread.join(2)
+            self.chat_manager.save_partial_reply(self.conversation_history, self.system_prompt, request.partial_text())
+            print("\n[generation stopped]", file=sys.stderr)
+            return True
+
+        if "error" in result:
+            print(f"\nError: {result['error']}", file=sys.stderr)
+            return False
+        response = result.get("response", "")
+        if not (self.stream and request.tokens):
+            # Non-streamed replies arrive in one piece.
+            sys.stdout.write(response)
+        sys.stdout.write("\n")
+        sys.stdout.flush()
+        self.conversation_history.append({"role": "assistant", "content": response})
+        self.chat_manager.save_chat_history(self.conversation_history, self.system_prompt)
+        return True
+
+    @staticmethod
+    def write_token(token):
+        sys.stdout.write(token)
+        sys.stdout.flush()
+
+    def handle_command(self, line):
+        """Run a /command typed at the interactive prompt; return False to quit."""
+        command, _, argument = line.partition(" ")
+        argument = argument.strip()
+        if command in ("/exit", "/quit"):
+            return False
+        if command == "/chat":
+            action, _, filename = argument.partition(" ")
+            filename = filename.strip()
+            if action == "open" and filename:
+                filename = ensure_json_extension(filename)
+                if not os.path.exists(filename):
+                    print(f"Chat {filename} does not exist.", file=sys.stderr)
+                else:
+                    self.open_chat(filename)
+                    print(f"Chat {filename} opened ({len(self.conversation_history)} messages).")
+            elif action == "new":
+                filename = ensure_json_extension(filename) if filename else self.chat_manager.get_next_available_filename()
+                self.chat_manager.chat_filename = filename
+                self.chat_manager.forget_persisted_state()
+                self.context_window.forget(filename)
+                self.conversation_history, self.system_prompt, self.chat_summary = [], "", None
+                self.chat_manager.save_chat_history(self.conversation_history, self.system_prompt)
+                print(f"New chat {filename} created and opened.")
+            else:
+                print("Usage: /chat open <file> | /chat new [file]", file=sys.stderr)
+        elif command == "/system_prompt":
+            self.system_prompt = argument
+            self.chat_manager.save_chat_history(self.conversation_history, self.system_prompt)
+            print("System prompt updated." if argument else "System prompt cleared.")
+        else:
+            print("Commands: /chat open <file>, /chat new [file], /system_prompt <text>, /exit", file=sys.stderr)
+        return True
+
+    def repl(self):
+        print(f"Retrochat - {self.chat_manager.chat_filename}, {self.mode} {self.model or '(server default)'}. "
+              f"/exit to quit, Ctrl-C stops a reply.")
+        while True:
+            try:
+                line = input("> ").strip()
+            except (EOFError, KeyboardInterrupt):
+                print()
+                return
+            if not line:
+                continue
+            if line.startswith("/"):
+                if not self.handle_command(line):
+                    return
+                continue
+            self.send(line)
+
+
+class HostSlots:
+    """Caps how many batch requests each host serves at once."""
+
+    def __init__(self, config, group, per_host):
+        self.config = config
+        self.group = group
+        self.hosts = HostBalancer.parse_hosts(config.get(group, "")) if group else [None]
+        self.per_host = per_host
+        self.in_use = {}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot and return its host (None for OpenAI)."""
+        with self.condition:
+            while True:
+                full = {host for host in self.hosts if self.in_use.get(host, 0) >= self.per_host}
+                if len(full) < len(self.hosts):
+                    if self.group is None:
+                        host = None
+                    else:
+                        host = HostBalancer.pick(self.group, self.config['baseurl'], self.hosts, exclude=full)
+                    self.in_use[host] = self.in_use.get(host, 0) + 1
+                    return host
+                self.condition.wait()
+
+    def release(self, host):
+        with self.condition:
+            self.in_use[host] -= 1
+            self.condition.notify()
+
+
+class BatchRunner:
+    """Sends every prompt of a JSONL file and appends one result line per prompt.
+
+    Each input line is a JSON object with "prompt" (or a full "messages"
+    list) and optionally "id", "system_prompt" and "model"; a bare JSON
+    string is taken as the prompt. Prompts are read and results written as
+    they go, so memory stays flat however long the file is. Results carry
+    the prompt's id (its line number when it has none); a prompt that
+    already has a successful result in the output file is skipped, so an
+    interrupted run picks up where it stopped. Invalid lines are reported
+    once, not again on every resume.
+    """
+    INVALID_LINE = "not a JSON prompt object"
+
+    def __init__(self, config, mode, model, stream, per_host):
+        self.config = config
+        self.mode = mode
+        self.model = model
+        self.stream = stream
+        group = {'ollama': 'ollamahost', 'llama.cpp': 'llamacpphost'}.get(mode)
+        self.slots = HostSlots(config, group, per_host)
+        self.context_window = ContextWindow()
+        self.output_lock = threading.Lock()
+        self.active = set()
+        self.stopping = False
+        self.counts = {"ok": 0, "error": 0, "skipped": 0}
+
+    @classmethod
+    def completed_ids(cls, output_path):
+        """Return the ids with a successful result and the ids already reported as invalid lines."""
+        done, invalid = set(), set()
+        if not os.path.exists(output_path):
+            return done, invalid
+        with open(output_path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line torn by an interrupted run; that prompt is sent again.
+                    continue
+                if not isinstance(record, dict):
+                    continue
+                if "response" in record:
+                    done.add(str(record.get("id")))
+                elif record.get("error") == cls.INVALID_LINE:
+                    invalid.add(str(record.get("id")))
+        return done, invalid
+
+    @staticmethod
+    def read_jobs(input_path):
+        """Yield (id, job) for each input line; job is None when the line is not valid."""
+        with open(input_path, 'r') as file:
+            for number, line in enumerate(file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    job = json.loads(line)
+                except json.JSONDecodeError:
+                    yield number, None
+                    continue
+                if isinstance(job, str):
+                    job = {"prompt": job}
+                if not isinstance(job, dict) or not (job.get("prompt") or job.get("messages")):
+                    yield number, None
+                    continue
+                yield job.get("id", number), job
+
+    def run(self, input_path, output_path):
+        if not self.slots.hosts:
+            print(f"Error: No hosts configured in {self.slots.group}.", file=sys.stderr)
+            return False
+        done, invalid = self.completed_ids(output_path)
+        workers = self.slots.per_host * len(self.slots.hosts)
+        jobs = queue.Queue(maxsize=workers)
+        threads = [threading.Thread(target=self.work, args=(jobs,), daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+
+        with open(output_path, 'a') as self.output:
+            try:
+                for job_id, job in self.read_jobs(input_path):
+                    if str(job_id) in done or (job is None and str(job_id) in invalid):
+                        self.counts["skipped"] += 1
+                    elif job is None:
+                        self.write_result({"id": job_id, "error": self.INVALID_LINE})
+                    else:
+                        jobs.put((job_id, job))
+                for _ in threads:
+                    jobs.put(None)
+                join_interruptibly(*threads)
+            except KeyboardInterrupt:
+                # Interrupted prompts get no result line, so the next run sends them again.
+                self.stopping = True
+                for request in list(self.active):
+                    request.cancel()
+                print("\nBatch interrupted; run the same command again to resume.", file=sys.stderr)
+        print(f"{self.counts['ok']} ok, {self.counts['error']} failed, "
+              f"{self.counts['skipped']} already done.", file=sys.stderr)
+        return self.counts["error"] == 0 and not self.stopping
+
+    def work(self, jobs):
+        while True:
+            item = jobs.get()
+            if item is None or self.stopping:
+                return
+            job_id, job = item
+            host = self.slots.acquire()
+            try:
+                result = self.send(job_id, job, host)
+            finally:
+                self.slots.release(host)
+            if result is not None and not self.stopping:
+                self.write_result(result)
+
+    def send(self, job_id, job, host):
+        """Run one prompt; return its result record, or None if it was cancelled."""
+        model = job.get("model") or self.model
+        history = job.get("messages") or [{"role": "user", "content": job["prompt"]}]
+        messages = build_messages(self.config, self.mode, model, job.get("system_prompt", ""), history, self.context_window)
+        try:
+            endpoint, data, headers, protocol, _ = build_chat_request(
+                self.config, self.mode, model, messages, f"batch:{job_id}", host=host)
+        except ValueError as e:
+            return {"id": job_id, "error": str(e)}
+
+        cache_key = ResponseCache.key_for(self.config, self.mode, data)
+        cached = ResponseCache.get(cache_key) if cache_key is not None else None
+        if cached is not None:
+            return {"id": job_id, "response": cached[0], "model": data.get("model"), "cached": True}
+
+        # No route: failover would move the job to another host without a
+        # slot there. HostSlots already steers new jobs away from dead hosts.
+        request = ChatRequest(endpoint, data, headers, stream=self.stream, protocol=protocol)
+        request.metrics_tags = {"backend": self.mode, "model": data.get("model") or "(server default)", "kind": "batch"}
+        request.cache_key = cache_key
+        result = {"id": job_id}
+        request.on_response = lambda text: result.setdefault("response", text)
+        request.on_error = lambda message: result.setdefault("error", message)
+        self.active.add(request)
+        try:
+            request.run()
+        finally:
+            self.active.discard(request)
+        if request.cancel_requested:
+            return None
+        result["model"] = data.get("model")
+        result.update(request.metrics or {})
+        if request.timings:
+            result["timings"] = request.timings
+        return result
+
+    def write_result(self, record):
+        with self.output_lock:
+            self.output.write(json.dumps(record) + "\n")
+            self.output.flush()
+            outcome = "error" if "error" in record else "ok"
+            self.counts[outcome] += 1
+            if outcome == "error":
+                detail = record["error"]
+            else:
+                detail = "cached" if record.get("cached") else f"{record.get('total_ms')} ms"
+            print(f"[{self.counts['ok'] + self.counts['error']}] {record['id']}: {outcome} ({detail})", file=sys.stderr)
+
+
+def join_interruptibly(*threads):
+    """Wait for threads; join() polls with a timeout so Ctrl-C still reaches the main thread."""
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.1)
+
+
+def ensure_json_extension(filename):
+    return filename if filename.endswith('.json') else f"{filename}.json"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chat with Ollama, llama.cpp or OpenAI from the terminal.")
+    parser.add_argument("prompt", nargs="*", help="send this message and exit (read from stdin when piped)")
+    parser.add_argument("-m", "--mode", choices=MODES, help="backend to use (default: the GUI's current mode)")
+    parser.add_argument("--model", help="model name (default: the GUI's selected model)")
+    parser.add_argument("--chat", help="chat file to continue (default: the GUI's current chat)")
+    parser.add_argument("--no-stream", action="store_true", help="wait for the whole reply instead of streaming it")
+    parser.add_argument("--batch", metavar="FILE", help="send every prompt of a JSONL file and write results as JSONL")
+    parser.add_argument("-o", "--output", metavar="FILE", help="batch results file (default: <batch file>.results.jsonl)")
+    parser.add_argument("--concurrency", type=int, help="batch requests per host at once (default: batch_concurrency)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = ConfigManager.load_config()
+    configure_logging(config)
+    mode = args.mode or config.get("current_mode") or "llama.cpp"
+    model = args.model if args.model is not None else config.get("selected_model", "")
+    if mode == "openai" and not model:
+        model = "gpt-4o"
+    chat_filename = ensure_json_extension(args.chat) if args.chat else (config.get("current_chat_filename") or "chat_1.json")
+    stream = bool(config.get("stream", True)) and not args.no_stream
+
+    if args.batch:
+        output_path = args.output or f"{os.path.splitext(args.batch)[0]}.results.jsonl"
+        per_host = max(1, args.concurrency or int(config.get("batch_concurrency", 2)))
+        runner = BatchRunner(config, mode, model, stream, per_host)
+        try:
+            return 0 if runner.run(args.batch, output_path) else 1
+        finally:
+            ConfigManager.flush()
+
+    session = ChatSession(config, mode, model, chat_filename, stream)
+    try:
+        if args.prompt or not sys.stdin.isatty():
+            prompt = " ".join(args.prompt) if args.prompt else sys.stdin.read().strip()
+            if not prompt:
+                print("Nothing to send.", file=sys.stderr)
+                return 2
+            return 0 if session.send(prompt) else 1
+        session.repl()
+        return 0
+    finally:
+        ConfigManager.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
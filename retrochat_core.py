@@ -0,0 +1,1920 @@
+"""Qt-free core of Retrochat: configuration, chat files, search and backend requests.
+
+Shared by the GUI (retrochat.py) and the command line (retrochat_cli.py), so
+nothing in here may import PyQt5.
+"""
+import os
+import socket
+import json
+import math
+import random
+import logging
+import copy
+import shutil
+import atexit
+import threading
+import hashlib
+import zlib
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+# requests is imported where it is first used, so it stays off the startup path.
+
+DATA_DIRNAME = ".retrochat"
+
+
+def data_path(filename):
+    """Path of an app-managed index or cache file, kept out of the chat directory listing."""
+    data_dir = os.path.join(os.getcwd(), DATA_DIRNAME)
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, filename)
+
+
+class ConfigManager:
+    """Process-wide configuration held in memory.
+
+    load_config parses config.json once and hands out the same dict to every
+    caller. Changes mark the config dirty and are written back in one batch
+    after FLUSH_DELAY seconds, or immediately by flush() (called on window
+    close and at interpreter exit).
+    """
+    CONFIG_FILENAME = "config.json"
+    FLUSH_DELAY = 2.0
+    DEFAULT_CONFIG = {
+        "baseurl": "http://",
+        "ollamahost": "192.168.1.82:11434",
+        "llamacpphost": "192.168.1.82:8080",
+        "path": "/v1/chat/completions",
+        "user_color": "#00FF00",
+        "assistant_color": "#FFBF00",
+        "fontsize": 18,
+        "current_chat_filename": "",
+        "selected_model": "",
+        "current_mode": "",
+        "openaiapikey": "",
+        "window_geometry": None,
+        "window_state": "normal",
+        "stream": True,
+        "http_pool_size": 10,
+        "http_timeouts": {
+            "default": [5, 300]
+        },
+        "probe_timeout": 2,
+        "render_cache_size": 2000,
+        "persist_render_cache": False,
+        "display_window": 200,
+        "display_page_size": 50,
+        "max_document_blocks": 5000,
+        "context_budget": {
+            "default": 8192
+        },
+        "reply_reserve_tokens": 1024,
+        "summarize": False,
+        "summary_trigger_tokens": 4096,
+        "summary_block_tokens": 2048,
+        "summary_keep_messages": 6,
+        "llamacpp_cache_prompt": True,
+        "llamacpp_slots": 1,
+        "show_timings": True,
+        "ollama_native": True,
+        "ollama_keep_alive": "30m",
+        "ollama_options": {},
+        "retry_attempts": 2,
+        "retry_backoff": 0.5,
+        "retry_backoff_max": 8,
+        "breaker_failures": 3,
+        "breaker_reset_seconds": 30,
+        "log_level": "INFO",
+        "metrics": True,
+        "metrics_max_records": 5000,
+        "transport": "live",
+        "transport_file": "traffic.jsonl",
+        "replay_speed": 1.0,
+        "batch_concurrency": 2,
+        "sampling_params": {},
+        "response_cache": False,
+        "response_cache_force": False,
+        "response_cache_max_mb": 50,
+        "response_cache_max_age_days": 30
+    }
+
+    _config = None
+    _dirty = False
+    _flush_timer = None
+    _lock = threading.RLock()
+
+    @classmethod
+    def load_config(cls):
+        with cls._lock:
+            if cls._config is None:
+                cls._config = cls.read_config()
+            return cls._config
+
+    @classmethod
+    def read_config(cls):
+        config_path = os.path.join(os.getcwd(), cls.CONFIG_FILENAME)
+        if not os.path.exists(config_path):
+            cls.write_config(cls.DEFAULT_CONFIG)
+            return copy.deepcopy(cls.DEFAULT_CONFIG)
+        try:
+            with open(config_path, 'r') as config_file:
+                config = json.load(config_file)
+                return cls.check_and_update_config(config)
+        except (json.JSONDecodeError, Exception):
+            cls.rename_old_file(cls.CONFIG_FILENAME)
+            cls.write_config(cls.DEFAULT_CONFIG)
+            return copy.deepcopy(cls.DEFAULT_CONFIG)
+
+    @classmethod
+    def write_config(cls, config):
+        config_path = os.path.join(os.getcwd(), cls.CONFIG_FILENAME)
+        temp_path = config_path + ".tmp"
+        with open(temp_path, 'w') as config_file:
+            json.dump(config, config_file, indent=4)
+        os.replace(temp_path, config_path)
+
+    @classmethod
+    def save_config(cls, config):
+        with cls._lock:
+            cls._config = config
+            cls.mark_dirty()
+
+    @classmethod
+    def save_window_state(cls, geometry, state):
+        with cls._lock:
+            config = cls.load_config()
+            config['window_geometry'] = geometry
+            config['window_state'] = state
+            cls.mark_dirty()
+
+    @classmethod
+    def save_config_value(cls, key, value):
+        with cls._lock:
+            config = cls.load_config()
+            if key in config and config[key] == value:
+                return
+            config[key] = value
+            cls.mark_dirty()
+
+    @classmethod
+    def mark_dirty(cls):
+        """Flag unsaved changes and schedule a write-back if none is pending."""
+        cls._dirty = True
+        if cls._flush_timer is None:
+            cls._flush_timer = threading.Timer(cls.FLUSH_DELAY, cls.flush)
+            cls._flush_timer.daemon = True
+            cls._flush_timer.start()
+
+    @classmethod
+    def flush(cls):
+        with cls._lock:
+            if cls._flush_timer is not None:
+                cls._flush_timer.cancel()
+                cls._flush_timer = None
+            if cls._dirty and cls._config is not None:
+                cls.write_config(dict(cls._config))
+                cls._dirty = False
+
+    @classmethod
+    def check_and_update_config(cls, config):
+        if isinstance(config, dict):
+            updated_config = cls.update_to_match_default(config, cls.DEFAULT_CONFIG)
+            if updated_config != config:
+                cls.write_config(updated_config)
+            return updated_config
+        else:
+            cls.rename_old_file(cls.CONFIG_FILENAME)
+            cls.write_config(cls.DEFAULT_CONFIG)
+            return copy.deepcopy(cls.DEFAULT_CONFIG)
+
+    @classmethod
+    def update_to_match_default(cls, data, default_structure):
+        if not isinstance(data, dict) or not isinstance(default_structure, dict):
+            return copy.deepcopy(default_structure)
+
+        updated_data = data.copy()
+        for key, default_value in default_structure.items():
+            if key not in updated_data:
+                updated_data[key] = copy.deepcopy(default_value)
+            elif isinstance(default_value, dict):
+                updated_data[key] = cls.update_to_match_default(updated_data[key], default_value)
+        return updated_data
+
+    @staticmethod
+    def rename_old_file(filename):
+        old_file_path = os.path.join(os.getcwd(), filename)
+        new_file_path = os.path.join(os.getcwd(), f"OLD_{filename}")
+        if os.path.exists(old_file_path):
+            shutil.move(old_file_path, new_file_path)
+
+
+atexit.register(ConfigManager.flush)
+
+
+class ChatHistoryManager:
+    """Persists a chat as an append-only JSON Lines log.
+
+    The first line is a header record holding the system prompt, followed by
+    one record per message. A turn only appends its new records; the file is
+    rewritten when the history no longer extends what is on disk or once
+    enough superseded records have piled up. Files in the old single-document
+    JSON layout are migrated the first time they are loaded.
+    """
+    LOG_VERSION = 2
+    COMPACTION_THRESHOLD = 64
+    COMPANION_SUFFIXES = [".render.jsonl", ".summary.jsonl"]
+
+    def __init__(self, chat_filename="chat_1.json"):
+        self.chat_filename = chat_filename
+        self.forget_persisted_state()
+
+    def forget_persisted_state(self):
+        self.persisted_filename = None
+        self.persisted_count = 0
+        self.persisted_last_message = None
+        self.persisted_system_prompt = None
+        self.stale_records = 0
+
+    def remember_persisted_state(self, chat_history, system_prompt, stale_records=0):
+        self.persisted_filename = self.chat_filename
+        self.persisted_count = len(chat_history)
+        self.persisted_last_message = dict(chat_history[-1]) if chat_history else None
+        self.persisted_system_prompt = system_prompt
+        self.stale_records = stale_records
+
+    def save_partial_reply(self, chat_history, system_prompt, partial):
+        """Keep what a stopped generation produced, so the history stays in user/assistant order."""
+        if partial:
+            chat_history.append({"role": "assistant", "content": partial})
+            self.save_chat_history(chat_history, system_prompt)
+
+    def save_chat_history(self, chat_history, system_prompt):
+        chat_history_path = os.path.join(os.getcwd(), self.chat_filename)
+        if self.can_append(chat_history_path, chat_history):
+            first_new = self.persisted_count
+            records = []
+            stale_records = self.stale_records
+            if system_prompt != self.persisted_system_prompt:
+                records.append({"type": "system_prompt", "system_prompt": system_prompt})
+                stale_records += 1
+            records.extend({"type": "message", "message": message} for message in chat_history[self.persisted_count:])
+            if records:
+                with open(chat_history_path, 'a') as file:
+                    file.writelines(json.dumps(record) + "\n" for record in records)
+            self.remember_persisted_state(chat_history, system_prompt, stale_records)
+        else:
+            first_new = None
+            self.write_chat_log(chat_history_path, chat_history, system_prompt)
+            self.remember_persisted_state(chat_history, system_prompt)
+        ChatCatalog.record_save(self.chat_filename, chat_history, first_new)
+        ConfigManager.save_config_value('current_chat_filename', self.chat_filename)
+
+    def can_append(self, chat_history_path, chat_history):
+        """Whether chat_history only extends what was last written to this file."""
+        if self.persisted_filename != self.chat_filename or self.stale_records >= self.COMPACTION_THRESHOLD:
+            return False
+        if len(chat_history) < self.persisted_count or not os.path.exists(chat_history_path):
+            return False
+        if self.persisted_count and chat_history[self.persisted_count - 1] != self.persisted_last_message:
+            return False
+        return True
+
+    def write_chat_log(self, path, chat_history, system_prompt):
+        """Rewrite a whole chat log, replacing the file atomically."""
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as file:
+            file.write(json.dumps({"type": "header", "version": self.LOG_VERSION, "system_prompt": system_prompt}) + "\n")
+            file.writelines(json.dumps({"type": "message", "message": message}) + "\n" for message in chat_history)
+        os.replace(temp_path, path)
+
+    def read_chat_log(self, path):
+        """Return (conversation_history, system_prompt, stale_records, intact) for a chat log."""
+        chat_history = []
+        system_prompt = ""
+        stale_records = -1
+        intact = True
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Most likely a write torn by a crash; keep what is readable.
+                    intact = False
+                    continue
+                record_type = record.get("type") if isinstance(record, dict) else None
+                if record_type == "message":
+                    chat_history.append(record["message"])
+                elif record_type in ("header", "system_prompt"):
+                    system_prompt = record.get("system_prompt", "")
+                    stale_records += 1
+        return chat_history, system_prompt, max(stale_records, 0), intact
+
+    @staticmethod
+    def is_chat_log(path):
+        with open(path, 'r') as file:
+            first_line = file.readline()
+        try:
+            record = json.loads(first_line)
+        except json.JSONDecodeError:
+            return False
+        return isinstance(record, dict) and record.get("type") == "header"
+
+    def load_chat_history(self):
+        chat_history_path = os.path.join(os.getcwd(), self.chat_filename)
+        self.forget_persisted_state()
+        if os.path.exists(chat_history_path):
+            if self.is_chat_log(chat_history_path):
+                chat_history, system_prompt, stale_records, intact = self.read_chat_log(chat_history_path)
+                if intact:
+                    self.remember_persisted_state(chat_history, system_prompt, stale_records)
+                return chat_history, system_prompt
+            try:
+                with open(chat_history_path, 'r') as file:
+                    chat_data = json.load(file)
+                    if isinstance(chat_data, dict):
+                        chat_history = chat_data.get("conversation_history", [])
+                        system_prompt = chat_data.get("system_prompt", "")
+                    else:
+                        raise json.JSONDecodeError("Invalid format", chat_history_path, 0)
+            except json.JSONDecodeError:
+                self.rename_old_file(self.chat_filename)
+                self.create_new_chat_file()
+                return [], ""
+            self.write_chat_log(chat_history_path, chat_history, system_prompt)
+            self.remember_persisted_state(chat_history, system_prompt)
+            return chat_history, system_prompt
+        return [], ""
+
+    def check_and_update_json_file(self, filename, expected_structure):
+        file_path = os.path.join(os.getcwd(), filename)
+        if not os.path.exists(file_path) or self.is_chat_log(file_path):
+            return
+
+        try:
+            with open(file_path, 'r') as file:
+                data = json.load(file)
+
+            if isinstance(data, dict):
+                updated_data = self.update_json_structure(data, expected_structure)
+                self.write_chat_log(file_path, updated_data["conversation_history"], updated_data["system_prompt"])
+            else:
+                raise json.JSONDecodeError("Invalid format", file_path, 0)
+
+        except json.JSONDecodeError:
+            self.rename_old_file(filename)
+            self.create_new_file_with_structure(filename, expected_structure)
+
+    def update_json_structure(self, data, expected_structure):
+        if not isinstance(data, dict) or not isinstance(expected_structure, dict):
+            return expected_structure
+
+        updated_data = data.copy()
+        for key, default_value in expected_structure.items():
+            if key not in updated_data:
+                updated_data[key] = default_value
+            elif isinstance(default_value, dict):
+                updated_data[key] = self.update_json_structure(updated_data[key], default_value)
+        return updated_data
+
+    @staticmethod
+    def is_chat_filename(filename):
+        return filename.endswith('.json') and filename != ConfigManager.CONFIG_FILENAME
+
+    def ensure_chat_files_are_up_to_date(self, expected_structure):
+        json_files = [f for f in os.listdir(os.getcwd()) if self.is_chat_filename(f)]
+        for file in json_files:
+            self.check_and_update_json_file(file, expected_structure)
+
+    def rename_old_file(self, filename):
+        old_file_path = os.path.join(os.getcwd(), filename)
+        new_file_path = os.path.join(os.getcwd(), f"OLD_{filename}")
+        if os.path.exists(old_file_path):
+            shutil.move(old_file_path, new_file_path)
+
+    def create_new_file_with_structure(self, filename, structure):
+        new_file_path = os.path.join(os.getcwd(), filename)
+        self.write_chat_log(new_file_path, structure.get("conversation_history", []), structure.get("system_prompt", ""))
+
+    def create_new_chat_file(self):
+        default_structure = {
+            "system_prompt": "",
+            "conversation_history": []
+        }
+        self.create_new_file_with_structure(self.chat_filename, default_structure)
+
+    def set_chat_filename(self, filename):
+        self.chat_filename = filename
+
+    def companion_path(self, suffix, filename=None):
+        """Path of a file stored next to a chat, e.g. chat_1.render.jsonl for chat_1.json."""
+        stem = os.path.splitext(filename or self.chat_filename)[0]
+        return os.path.join(os.getcwd(), stem + suffix)
+
+    def load_summary(self, chat_history):
+        """Return the latest rolling summary record that still matches chat_history, or None."""
+        path = self.companion_path(".summary.jsonl")
+        if not os.path.exists(path):
+            return None
+        summary = None
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    summary = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+        if summary is None or summary.get("covered", 0) > len(chat_history):
+            return None
+        return summary
+
+    def save_summary(self, summary):
+        with open(self.companion_path(".summary.jsonl"), 'a') as file:
+            file.write(json.dumps(summary) + "\n")
+
+    def move_companion_files(self, old_filename, new_filename):
+        for suffix in self.COMPANION_SUFFIXES:
+            old_path = self.companion_path(suffix, old_filename)
+            if os.path.exists(old_path):
+                shutil.move(old_path, self.companion_path(suffix, new_filename))
+
+    def delete_companion_files(self, filename):
+        for suffix in self.COMPANION_SUFFIXES:
+            path = self.companion_path(suffix, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_next_available_filename(self):
+        index = 1
+        while True:
+            filename = f"chat_{index}.json"
+            if not os.path.exists(filename):
+                return filename
+            index += 1
+
+
+class ChatCatalog:
+    """Persistent index of the chat files in the working directory.
+
+    For each chat it stores the size and mtime seen when it was last indexed,
+    plus its message count, schema version and title. refresh() only opens
+    files whose size or mtime changed since then (or that the search index
+    is missing); saves, renames and deletes keep the catalog and the
+    SearchIndex current as they happen. Like ConfigManager, changes are
+    written back in batches.
+    """
+    CATALOG_FILENAME = "catalog.json"
+    SCHEMA_VERSION = ChatHistoryManager.LOG_VERSION
+    TITLE_LENGTH = 60
+    FLUSH_DELAY = 2.0
+
+    _entries = None
+    _dirty = False
+    _flush_timer = None
+    _lock = threading.RLock()
+    # Held for a whole refresh, so two never migrate or index the same file at once.
+    _refresh_lock = threading.Lock()
+
+    @classmethod
+    def entries(cls):
+        with cls._lock:
+            if cls._entries is None:
+                cls._entries = cls.read_catalog()
+            return cls._entries
+
+    @classmethod
+    def read_catalog(cls):
+        try:
+            with open(data_path(cls.CATALOG_FILENAME), 'r') as file:
+                entries = json.load(file)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    @classmethod
+    def refresh(cls):
+        """Bring the catalog in line with the directory, re-reading only changed files.
+
+        The lock is only held while entries change, not while files are read
+        or indexed, so saves from the GUI thread never wait on a long scan.
+        Refreshes run one at a time; one that waited on another finds little
+        left to re-read.
+        """
+        with cls._refresh_lock:
+            return cls.refresh_unlocked()
+
+    @classmethod
+    def refresh_unlocked(cls):
+        with cls._lock:
+            entries = dict(cls.entries())
+        indexed_counts = SearchIndex.indexed_counts()
+        seen = set()
+        with os.scandir(os.getcwd()) as directory:
+            for dir_entry in directory:
+                if not dir_entry.is_file() or not ChatHistoryManager.is_chat_filename(dir_entry.name):
+                    continue
+                seen.add(dir_entry.name)
+                stat = dir_entry.stat()
+                known = entries.get(dir_entry.name)
+                unchanged = known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns
+                searchable = known is not None and indexed_counts.get(dir_entry.name) == known["message_count"]
+                if unchanged and (searchable or not SearchIndex.available()):
+                    continue
+                cls.index_file(dir_entry.name)
+        for filename in (set(entries) | set(indexed_counts)) - seen:
+            # Skip chats saved or renamed into place while the scan ran.
+            if not os.path.exists(os.path.join(os.getcwd(), filename)):
+                cls.record_delete(filename)
+        with cls._lock:
+            return dict(cls.entries())
+
+    @classmethod
+    def index_file(cls, filename):
+        manager = ChatHistoryManager(filename)
+        path = os.path.join(os.getcwd(), filename)
+        manager.check_and_update_json_file(filename, {"system_prompt": "", "conversation_history": []})
+        if not os.path.exists(path):
+            return
+        chat_history = manager.read_chat_log(path)[0]
+        cls.record_save(filename, chat_history)
+
+    @classmethod
+    def record_save(cls, filename, chat_history, first_new=None):
+        """Update a chat's entry after a save; first_new is the index of the first appended message."""
+        SearchIndex.record_save(filename, chat_history, first_new)
+        path = os.path.join(os.getcwd(), filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with cls._lock:
+            cls.entries()[filename] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "message_count": len(chat_history),
+                "schema_version": cls.SCHEMA_VERSION,
+                "title": cls.make_title(chat_history)
+            }
+            cls.mark_dirty()
+
+    @classmethod
+    def make_title(cls, chat_history):
+        for message in chat_history:
+            if message.get("role") == "user" and message.get("content", "").strip():
+                title = message["content"].strip().splitlines()[0]
+                return title if len(title) <= cls.TITLE_LENGTH else title[:cls.TITLE_LENGTH - 3] + "..."
+        return ""
+
+    @classmethod
+    def record_rename(cls, old_filename, new_filename):
+        SearchIndex.record_rename(old_filename, new_filename)
+        with cls._lock:
+            entry = cls.entries().pop(old_filename, None)
+            if entry is not None:
+                cls.entries()[new_filename] = entry
+                cls.mark_dirty()
+
+    @classmethod
+    def record_delete(cls, filename):
+        SearchIndex.record_delete(filename)
+        with cls._lock:
+            if cls.entries().pop(filename, None) is not None:
+                cls.mark_dirty()
+
+    @classmethod
+    def mark_dirty(cls):
+        cls._dirty = True
+        if cls._flush_timer is None:
+            cls._flush_timer = threading.Timer(cls.FLUSH_DELAY, cls.flush)
+            cls._flush_timer.daemon = True
+            cls._flush_timer.start()
+
+    @classmethod
+    def flush(cls):
+        with cls._lock:
+            if cls._flush_timer is not None:
+                cls._flush_timer.cancel()
+                cls._flush_timer = None
+            if cls._dirty and cls._entries is not None:
+                path = data_path(cls.CATALOG_FILENAME)
+                with open(path + ".tmp", 'w') as file:
+                    json.dump(cls._entries, file, indent=4)
+                os.replace(path + ".tmp", path)
+                cls._dirty = False
+
+
+atexit.register(ChatCatalog.flush)
+
+
+class SearchIndex:
+    """Full-text index over every chat's messages, kept in SQLite FTS5.
+
+    message_refs maps each indexed message to its chat and position, and
+    message_text holds the searchable content under the same rowid. Saves
+    that append to a chat only index the new messages; anything else
+    reindexes that one chat.
+    """
+    INDEX_FILENAME = "search.sqlite3"
+    SNIPPET_OPEN = "\x02"
+    SNIPPET_CLOSE = "\x03"
+
+    _connection = None
+    _unavailable = False
+    _lock = threading.RLock()
+
+    @classmethod
+    def connection(cls):
+        if cls._connection is None and not cls._unavailable:
+            try:
+                connection = sqlite3.connect(data_path(cls.INDEX_FILENAME), check_same_thread=False)
+                connection.executescript("""
+                    PRAGMA journal_mode=WAL;
+                    PRAGMA synchronous=NORMAL;
+                    CREATE TABLE IF NOT EXISTS indexed_chats (filename TEXT PRIMARY KEY, indexed_count INTEGER NOT NULL);
+                    CREATE TABLE IF NOT EXISTS message_refs (id INTEGER PRIMARY KEY, chat TEXT NOT NULL, position INTEGER NOT NULL, role TEXT NOT NULL);
+                    CREATE INDEX IF NOT EXISTS message_refs_chat ON message_refs (chat);
+                    CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5(content);
+                """)
+                cls._connection = connection
+            except sqlite3.Error:
+                # Typically an SQLite build without FTS5; search is then unavailable.
+                cls._unavailable = True
+        return cls._connection
+
+    @classmethod
+    def available(cls):
+        return cls.connection() is not None
+
+    @classmethod
+    def indexed_counts(cls):
+        with cls._lock:
+            connection = cls.connection()
+            if connection is None:
+                return {}
+            return dict(connection.execute("SELECT filename, indexed_count FROM indexed_chats"))
+
+    @classmethod
+    def record_save(cls, filename, chat_history, first_new=None):
+        with cls._lock:
+            connection = cls.connection()
+            if connection is None:
+                return
+            row = connection.execute("SELECT indexed_count FROM indexed_chats WHERE filename = ?", (filename,)).fetchone()
+            if first_new is None or row is None or row[0] != first_new:
+                cls.delete_rows(connection, filename)
+                first_new = 0
+            with connection:
+                for position in range(first_new, len(chat_history)):
+                    message = chat_history[position]
+                    cursor = connection.execute(
+                        "INSERT INTO message_refs (chat, position, role) VALUES (?, ?, ?)",
+                        (filename, position, message.get("role", "")))
+                    connection.execute("INSERT INTO message_text (rowid, content) VALUES (?, ?)",
+                                       (cursor.lastrowid, message.get("content", "")))
+                connection.execute("INSERT OR REPLACE INTO indexed_chats (filename, indexed_count) VALUES (?, ?)",
+                                   (filename, len(chat_history)))
+
+    @staticmethod
+    def delete_rows(connection, filename):
+        with connection:
+            connection.execute("DELETE FROM message_text WHERE rowid IN (SELECT id FROM message_refs WHERE chat = ?)", (filename,))
+            connection.execute("DELETE FROM message_refs WHERE chat = ?", (filename,))
+            connection.execute("DELETE FROM indexed_chats WHERE filename = ?", (filename,))
+
+    @classmethod
+    def record_rename(cls, old_filename, new_filename):
+        with cls._lock:
+            connection = cls.connection()
+            if connection is None:
+                return
+            with connection:
+                connection.execute("UPDATE message_refs SET chat = ? WHERE chat = ?", (new_filename, old_filename))
+                connection.execute("UPDATE indexed_chats SET filename = ? WHERE filename = ?", (new_filename, old_filename))
+
+    @classmethod
+    def record_delete(cls, filename):
+        with cls._lock:
+            connection = cls.connection()
+            if connection is not None:
+                cls.delete_rows(connection, filename)
+
+    @classmethod
+    def search(cls, query, limit=20):
+        """Return up to limit (chat, position, role, snippet) hits, best match first."""
+        terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+        if not terms:
+            return []
+        with cls._lock:
+            connection = cls.connection()
+            if connection is None:
+                return []
+            return connection.execute(
+                f"""SELECT message_refs.chat, message_refs.position, message_refs.role,
+                           snippet(message_text, 0, '{cls.SNIPPET_OPEN}', '{cls.SNIPPET_CLOSE}', '...', 16)
+                    FROM message_text JOIN message_refs ON message_refs.id = message_text.rowid
+                    WHERE message_text MATCH ? ORDER BY rank LIMIT ?""",
+                (" ".join(terms), limit)).fetchall()
+
+
+class RenderCache:
+    """Bounded LRU cache of rendered message HTML.
+
+    Entries are keyed by a hash of the message content and its role; colours
+    live in the document stylesheet, so the HTML does not depend on them.
+    When attached to a file, newly rendered entries are appended to it as
+    JSON Lines so that reopening the chat can skip the Markdown pass for
+    messages that were already rendered.
+    """
+
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.path = None
+        self.persisted_keys = set()
+        # Lines in the attached file, including ones for entries since evicted.
+        self.persisted_lines = 0
+        self.pending_keys = []
+
+    @staticmethod
+    def make_key(content, role):
+        return hashlib.sha1(f"{role}\0{content}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        html = self.entries.get(key)
+        if html is not None:
+            self.entries.move_to_end(key)
+        return html
+
+    def put(self, key, html):
+        self.entries[key] = html
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if self.path is not None and key not in self.persisted_keys:
+            self.pending_keys.append(key)
+
+    def attach(self, path):
+        """Persist to path from now on, loading whatever it already holds."""
+        if path == self.path:
+            return
+        self.save()
+        self.path = path
+        self.persisted_keys = set()
+        self.persisted_lines = 0
+        self.pending_keys = []
+        if path is None or not os.path.exists(path):
+            return
+        records = []
+        with open(path, 'r') as file:
+            for line in file:
+                self.persisted_lines += 1
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        # Loaded entries count as older than those in memory, and the file's
+        # newest lines as the most recent of them, so trimming drops its head.
+        for record in reversed(records):
+            self.persisted_keys.add(record["key"])
+            if record["key"] not in self.entries:
+                self.entries[record["key"]] = record["html"]
+                self.entries.move_to_end(record["key"], last=False)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def save(self):
+        """Append pending entries to the attached file, compacting it once it holds twice what the cache does."""
+        if self.path is None or not self.pending_keys:
+            return
+        new_keys = [key for key in dict.fromkeys(self.pending_keys) if key in self.entries and key not in self.persisted_keys]
+        self.pending_keys = []
+        if self.persisted_lines + len(new_keys) > 2 * self.max_entries:
+            keys = [key for key in self.entries if key in self.persisted_keys or key in new_keys]
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w') as file:
+                file.writelines(json.dumps({"key": key, "html": self.entries[key]}) + "\n" for key in keys)
+            os.replace(temp_path, self.path)
+            self.persisted_keys = set(keys)
+            self.persisted_lines = len(keys)
+        elif new_keys:
+            with open(self.path, 'a') as file:
+                file.writelines(json.dumps({"key": key, "html": self.entries[key]}) + "\n" for key in new_keys)
+            self.persisted_keys.update(new_keys)
+            self.persisted_lines += len(new_keys)
+
+
+class ContextWindow:
+    """Fits the messages of a request into a token budget.
+
+    Token counts are estimated from the message length (roughly four
+    characters per token plus a small per-message overhead) and cached per
+    message. The system prompt and the newest message are always kept; older
+    turns are dropped from the front until the rest fits.
+
+    When fit() is given an anchor key (the chat filename), the first kept
+    turn stays put for as long as everything after it fits. Once it no
+    longer does, the window is cut back to TRIM_TARGET of the budget in one
+    step. The request prefix therefore only changes every few turns, and
+    llama.cpp can keep reusing its KV cache in between.
+    """
+    CHARS_PER_TOKEN = 4
+    MESSAGE_OVERHEAD = 4
+    MAX_CACHED = 20000
+    TRIM_TARGET = 0.75
+
+    def __init__(self):
+        self.token_counts = OrderedDict()
+        self.anchors = {}
+
+    def estimate_tokens(self, message):
+        key = (message.get("role", ""), message.get("content", ""))
+        tokens = self.token_counts.get(key)
+        if tokens is None:
+            tokens = len(key[1]) // self.CHARS_PER_TOKEN + self.MESSAGE_OVERHEAD
+            self.token_counts[key] = tokens
+            if len(self.token_counts) > self.MAX_CACHED:
+                self.token_counts.popitem(last=False)
+        return tokens
+
+    @staticmethod
+    def budget_for(config, mode, model):
+        """Prompt budget for a model: its own context_budget entry, else its mode's, else the default."""
+        budgets = config.get("context_budget") or {}
+        budget = budgets.get(model) or budgets.get(mode) or budgets.get("default") or 8192
+        return int(budget) - int(config.get("reply_reserve_tokens", 1024))
+
+    def fit(self, system_message, history, budget, first=0, anchor_key=None):
+        """Return the system message plus the newest turns of history[first:] that fit budget."""
+        available = budget - self.estimate_tokens(system_message)
+        # A first past the end (a stale summary) must still leave the newest message in.
+        first = min(first, max(len(history) - 1, 0))
+        anchor = max(first, self.anchors.get(anchor_key, first)) if anchor_key is not None else first
+        if anchor_key is not None and anchor < len(history) \
+                and sum(self.estimate_tokens(message) for message in history[anchor:]) <= available:
+            start = anchor
+        else:
+            target = int(available * self.TRIM_TARGET) if anchor_key is not None else available
+            start = self.fill_from_newest(history, first, target)
+        # Chat templates expect the turns after the system prompt to open with the user.
+        while start < len(history) - 1 and history[start].get("role") == "assistant":
+            start += 1
+        if anchor_key is not None:
+            self.anchors[anchor_key] = start
+        return [system_message] + history[start:]
+
+    def forget(self, anchor_key):
+        """Drop anchor_key's anchor, for when its history is replaced by another."""
+        self.anchors.pop(anchor_key, None)
+
+    def fill_from_newest(self, history, first, available):
+        start = len(history)
+        while start > first:
+            tokens = self.estimate_tokens(history[start - 1])
+            if tokens > available and start < len(history):
+                break
+            available -= tokens
+            start -= 1
+        return start
+
+
+logger = logging.getLogger("retrochat")
+
+
+def configure_logging(config):
+    """Print the retrochat logger's records (retries, failovers, circuit changes) to stderr."""
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s", "%H:%M:%S"))
+    logger.addHandler(handler)
+    level = logging.getLevelName(str(config.get("log_level", "INFO")).upper())
+    logger.setLevel(level if isinstance(level, int) else logging.INFO)
+    logger.propagate = False
+
+
+class CircuitBreaker:
+    """Tracks the health of one backend host so a dead one fails fast.
+
+    After "breaker_failures" consecutive failures the circuit opens and requests
+    are refused without touching the network. Once "breaker_reset_seconds" have
+    passed a single trial request is let through (half-open); its outcome closes
+    or re-opens the circuit.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, host):
+        self.host = host
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Return (allowed, seconds until the next trial)."""
+        config = ConfigManager.load_config()
+        reset_seconds = float(config.get("breaker_reset_seconds", 30))
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True, 0
+            wait = self.opened_at + reset_seconds - time.monotonic()
+            if self.state == self.OPEN and wait <= 0:
+                self.transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self.trial_running:
+                self.trial_running = True
+                return True, 0
+            return False, max(wait, 0)
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.trial_running = False
+            if self.state != self.CLOSED:
+                self.transition(self.CLOSED)
+
+    def release(self):
+        with self.lock:
+            self.trial_running = False
+
+    def is_open(self):
+        """Whether requests to this host are currently being refused."""
+        if self.state == self.CLOSED:
+            return False
+        reset_seconds = float(ConfigManager.load_config().get("breaker_reset_seconds", 30))
+        return self.state == self.HALF_OPEN or time.monotonic() < self.opened_at + reset_seconds
+
+    def record_failure(self):
+        threshold = int(ConfigManager.load_config().get("breaker_failures", 3))
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= threshold):
+                self.opened_at = time.monotonic()
+                self.transition(self.OPEN)
+
+    def transition(self, state):
+        level = logging.WARNING if state == self.OPEN else logging.INFO
+        logger.log(level, "circuit for %s: %s -> %s (%d consecutive failures)", self.host, self.state, state, self.failures)
+        self.state = state
+
+
+class SessionPool:
+    """Keep-alive HTTP sessions shared by every thread, one per backend host.
+
+    Reusing a session keeps the TCP (and TLS) connection to Ollama, llama.cpp
+    or OpenAI open between requests. Timeouts are looked up per host in the
+    "http_timeouts" config as [connect, read] seconds, falling back to the
+    "default" entry.
+
+    Connection errors, 429 and 5xx responses are retried up to
+    "retry_attempts" times with jittered exponential backoff, honoring
+    Retry-After, and every host has a CircuitBreaker in front of it.
+    """
+    _sessions = {}
+    _breakers = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def host_key(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    @classmethod
+    def session_for(cls, url):
+        host = cls.host_key(url)
+        with cls._lock:
+            session = cls._sessions.get(host)
+            if session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                pool_size = int(ConfigManager.load_config().get("http_pool_size", 10))
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                cls._sessions[host] = session
+            return session
+
+    @classmethod
+    def timeout_for(cls, url):
+        timeouts = ConfigManager.load_config().get("http_timeouts") or {}
+        timeout = timeouts.get(urlsplit(url).netloc) or timeouts.get("default") or [5, 300]
+        return tuple(timeout)
+
+    @classmethod
+    def breaker_for(cls, url):
+        host = cls.host_key(url)
+        with cls._lock:
+            breaker = cls._breakers.get(host)
+            if breaker is None:
+                breaker = cls._breakers[host] = CircuitBreaker(host)
+            return breaker
+
+    @classmethod
+    def request(cls, method, url, retries=None, **kwargs):
+        """Send a request through the host's session, retrying transient failures.
+
+        Pass retries=0 for calls that must answer quickly, such as health probes.
+        """
+        import requests
+
+        config = ConfigManager.load_config()
+        if retries is None:
+            retries = int(config.get("retry_attempts", 2))
+        kwargs.setdefault("timeout", cls.timeout_for(url))
+        session = cls.session_for(url)
+        breaker = cls.breaker_for(url)
+
+        attempt = 0
+        while True:
+            allowed, wait = breaker.allow()
+            if not allowed:
+                raise requests.ConnectionError(f"{breaker.host} is unavailable after repeated failures; retrying in {wait:.0f} s")
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                breaker.record_failure()
+                if attempt >= retries:
+                    raise
+                delay = cls.backoff(attempt, config)
+            except requests.RequestException:
+                # Not the host's fault (a bad URL, say); don't hold the trial slot.
+                breaker.release()
+                raise
+            else:
+                if response.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if attempt >= retries or not (response.status_code == 429 or response.status_code >= 500):
+                    return response
+                delay = cls.retry_after(response)
+                if delay is None:
+                    delay = cls.backoff(attempt, config)
+                elif delay > float(config.get("retry_backoff_max", 8)):
+                    # The server wants us to wait longer than we are willing to.
+                    return response
+                response.close()
+            attempt += 1
+            logger.info("retrying %s %s in %.1f s (attempt %d of %d)", method, url, delay, attempt, retries)
+            time.sleep(delay)
+
+    @staticmethod
+    def backoff(attempt, config):
+        """Full-jitter exponential backoff for the given retry attempt."""
+        base = float(config.get("retry_backoff", 0.5))
+        cap = float(config.get("retry_backoff_max", 8))
+        return random.uniform(0, min(cap, base * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(response):
+        """Seconds asked for by a Retry-After header, or None."""
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def get(cls, url, **kwargs):
+        return cls.request("GET", url, **kwargs)
+
+    @classmethod
+    def post(cls, url, **kwargs):
+        return cls.request("POST", url, **kwargs)
+
+    @classmethod
+    def close_all(cls):
+        with cls._lock:
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions.clear()
+
+
+class RecordingResponse:
+    """Wraps a live response and captures what was read from it for Transport."""
+
+    def __init__(self, response, record, started):
+        self.response = response
+        self.record = record
+        self.started = started
+        self.saved = False
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def iter_lines(self):
+        for line in self.response.iter_lines():
+            self.record["chunks"].append([round(time.monotonic() - self.started, 4), line.decode('utf-8', errors='replace')])
+            yield line
+
+    def json(self):
+        return json.loads(self.text)
+
+    @property
+    def text(self):
+        return self.response.text
+
+    def close(self):
+        if not self.saved:
+            self.saved = True
+            if not self.record["stream"] or self.response.status_code != 200:
+                self.record["body"] = self.response.text
+            Transport.save_record(self.record)
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplayResponse:
+    """A recorded exchange served back by Transport, with its original pacing scaled by speed."""
+
+    def __init__(self, record, speed):
+        self.record = record
+        self.speed = speed
+        self.status_code = record["status"]
+        self.headers = {}
+        self.raw = None
+        self.text = record.get("body") or ""
+        self.elapsed = timedelta(seconds=record["headers_s"])
+        self.started = time.monotonic()
+        self.pause(record["headers_s"])
+
+    def pause(self, until):
+        """Sleep until `until` recorded seconds (scaled by speed) after the request started."""
+        if self.speed > 0:
+            delay = self.started + until / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def iter_lines(self):
+        if not self.record["stream"]:
+            # Recorded before replies were always streamed: serve the body as lines.
+            for line in self.text.splitlines():
+                yield line.encode('utf-8')
+            return
+        for offset, line in self.record["chunks"]:
+            self.pause(offset)
+            yield line.encode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Transport:
+    """What NetworkWorker sends its requests through.
+
+    "transport" is "live" (straight to SessionPool), "record" (live, and every
+    exchange, including when each streamed line arrived, is appended to
+    .retrochat/<transport_file>) or "replay" (answers are served from that
+    file without touching the network, at "replay_speed" times the recorded
+    pace, 0 meaning no delays). Replay looks for an exchange with the same
+    request body first, then falls back to the next unused one for the path,
+    so a slightly different session still replays in order.
+    """
+    _lock = threading.Lock()
+    _replay = None
+    _replay_path = None
+
+    @staticmethod
+    def request_key(method, url, body):
+        canonical = json.dumps([method, urlsplit(url).path, body], sort_keys=True)
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def post(cls, url, headers=None, json=None, stream=False):
+        config = ConfigManager.load_config()
+        mode = config.get("transport", "live")
+        if mode == "replay":
+            return cls.replay("POST", url, json, float(config.get("replay_speed", 1.0)))
+
+        started = time.monotonic()
+        response = SessionPool.post(url, headers=headers, json=json, stream=stream)
+        if mode != "record":
+            return response
+        record = {
+            "method": "POST",
+            "path": urlsplit(url).path,
+            "key": cls.request_key("POST", url, json),
+            "request": json,
+            "status": response.status_code,
+            "headers_s": round(time.monotonic() - started, 4),
+            "stream": stream,
+            "chunks": []
+        }
+        return RecordingResponse(response, record, started)
+
+    @classmethod
+    def save_record(cls, record):
+        path = data_path(ConfigManager.load_config().get("transport_file", "traffic.jsonl"))
+        with cls._lock:
+            with open(path, 'a') as file:
+                file.write(json.dumps(record) + "\n")
+
+    @classmethod
+    def replay(cls, method, url, body, speed):
+        import requests
+
+        path = data_path(ConfigManager.load_config().get("transport_file", "traffic.jsonl"))
+        with cls._lock:
+            if cls._replay is None or cls._replay_path != path:
+                cls._replay = MetricsStore.read_records(path)
+                cls._replay_path = path
+            key = cls.request_key(method, url, body)
+            url_path = urlsplit(url).path
+            candidates = [r for r in cls._replay if r["key"] == key] or [r for r in cls._replay if r["path"] == url_path]
+            if not candidates:
+                raise requests.ConnectionError(f"No recorded response for {method} {url_path} in {path}")
+            record = candidates[0]
+            # Each recording is served once, in order; a finished file starts over.
+            cls._replay.remove(record)
+            if not cls._replay:
+                cls._replay = None
+        return ReplayResponse(record, speed)
+
+
+class HostBalancer:
+    """Spreads chats over several Ollama or llama.cpp hosts.
+
+    "ollamahost" and "llamacpphost" may hold a list of hosts (or a comma
+    separated string). A chat sticks to the host it was first sent to, so the
+    server keeps its KV cache warm; a new chat goes to the healthy host with the
+    lowest (requests in flight + 1) x recent latency. When a host fails, the
+    chat moves to the next best one.
+    """
+    LATENCY_DECAY = 0.3
+    _lock = threading.RLock()
+    _groups = {}
+    _sticky = {}
+    _in_flight = {}
+    _latency = {}
+    # Host -> when a probe last found it offline.
+    _down = {}
+
+    @staticmethod
+    def parse_hosts(value):
+        if isinstance(value, str):
+            value = value.replace(",", " ").split()
+        return [str(host).strip() for host in value if str(host).strip()]
+
+    @classmethod
+    def healthy(cls, baseurl, host):
+        return not cls.is_down(host) and not SessionPool.breaker_for(f"{baseurl}{host}").is_open()
+
+    @classmethod
+    def is_down(cls, host):
+        """Whether a probe found host offline recently; like an open breaker, that lapses after breaker_reset_seconds."""
+        marked = cls._down.get(host)
+        if marked is None:
+            return False
+        return time.monotonic() - marked < float(ConfigManager.load_config().get("breaker_reset_seconds", 30))
+
+    @classmethod
+    def score(cls, host, chat_key):
+        # Hosts that have not answered yet are assumed as fast as the best one, so they get tried.
+        latency = cls._latency.get(host, min(cls._latency.values(), default=1.0))
+        load = (cls._in_flight.get(host, 0) + 1) * latency
+        # Loads within about 20% of each other count as equal, and ties are broken
+        # by hashing the chat so comparable hosts share new chats evenly.
+        bucket = round(math.log2(max(load, 0.001)) * 4)
+        return bucket, zlib.crc32(f"{chat_key}@{host}".encode('utf-8'))
+
+    @classmethod
+    def pick(cls, group, baseurl, hosts, chat_key=None, exclude=()):
+        """Return the host for chat_key among hosts, or None if there are none."""
+        with cls._lock:
+            cls._groups[group] = (baseurl, hosts)
+            candidates = [host for host in hosts if host not in exclude]
+            sticky = cls._sticky.get((group, chat_key))
+            if sticky in candidates and cls.healthy(baseurl, sticky):
+                return sticky
+            healthy = [host for host in candidates if cls.healthy(baseurl, host)] or candidates
+            if not healthy:
+                return None
+            host = min(healthy, key=lambda host: cls.score(host, chat_key))
+            if chat_key is not None:
+                cls._sticky[(group, chat_key)] = host
+            return host
+
+    @classmethod
+    def failover(cls, group, chat_key, failed_host, tried=()):
+        """Move chat_key off failed_host to a host not in tried; return the new host or None."""
+        with cls._lock:
+            if group not in cls._groups:
+                return None
+            baseurl, hosts = cls._groups[group]
+            cls._sticky.pop((group, chat_key), None)
+            host = cls.pick(group, baseurl, hosts, chat_key, exclude=set(tried) | {failed_host})
+            if host is not None:
+                logger.warning("%s failed; moving %s to %s", failed_host, chat_key, host)
+            return host
+
+    @classmethod
+    def begin(cls, host):
+        with cls._lock:
+            cls._in_flight[host] = cls._in_flight.get(host, 0) + 1
+
+    @classmethod
+    def finish(cls, host, latency=None):
+        with cls._lock:
+            cls._in_flight[host] = max(cls._in_flight.get(host, 0) - 1, 0)
+            if latency is not None:
+                # It answered, so a host the last probe found offline is back.
+                cls._down.pop(host, None)
+                previous = cls._latency.get(host, latency)
+                cls._latency[host] = previous + cls.LATENCY_DECAY * (latency - previous)
+
+    @classmethod
+    def mark_status(cls, host, online):
+        with cls._lock:
+            if online:
+                cls._down.pop(host, None)
+            else:
+                cls._down[host] = time.monotonic()
+
+    @classmethod
+    def count_online(cls, hosts):
+        with cls._lock:
+            return sum(1 for host in hosts if host not in cls._down)
+
+
+class MetricsStore:
+    """Appends one record per backend request to .retrochat/metrics.jsonl.
+
+    Records carry the backend, host and model plus queue time, time to the
+    response headers, time to first token, total latency, token counts and
+    tokens per second. The file is trimmed to the newest "metrics_max_records"
+    records once it grows to twice that.
+    """
+    FILENAME = "metrics.jsonl"
+    PERCENTILES = (50, 90, 99)
+    _lock = threading.Lock()
+    _line_count = None
+
+    @classmethod
+    def path(cls):
+        return data_path(cls.FILENAME)
+
+    @classmethod
+    def record(cls, record):
+        config = ConfigManager.load_config()
+        if not config.get("metrics", True):
+            return
+        max_records = int(config.get("metrics_max_records", 5000))
+        with cls._lock:
+            path = cls.path()
+            if cls._line_count is None:
+                cls._line_count = len(cls.read_records(path))
+            with open(path, 'a') as file:
+                file.write(json.dumps(record) + "\n")
+            cls._line_count += 1
+            if cls._line_count >= 2 * max_records:
+                records = cls.read_records(path)[-max_records:]
+                with open(path + ".tmp", 'w') as file:
+                    file.writelines(json.dumps(record) + "\n" for record in records)
+                os.replace(path + ".tmp", path)
+                cls._line_count = len(records)
+
+    @staticmethod
+    def read_records(path):
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return records
+
+    @classmethod
+    def load(cls):
+        with cls._lock:
+            return cls.read_records(cls.path())
+
+    @staticmethod
+    def percentile(values, percent):
+        """Nearest-rank percentile of an already sorted list."""
+        if not values:
+            return None
+        rank = max(int(math.ceil(percent / 100 * len(values))) - 1, 0)
+        return values[rank]
+
+    @classmethod
+    def summarize(cls, records, key):
+        """Group records by key(record) into {group: {count, errors, field: [p50, p90, p99]}}."""
+        groups = {}
+        for record in records:
+            groups.setdefault(key(record), []).append(record)
+
+        summary = {}
+        for group, members in groups.items():
+            stats = {"count": len(members), "errors": sum(1 for r in members if r.get("outcome") == "error")}
+            for field in ("queue_ms", "headers_ms", "ttft_ms", "total_ms", "tokens_per_s"):
+                values = sorted(r[field] for r in members if r.get(field) is not None and r.get("outcome") == "ok")
+                stats[field] = [cls.percentile(values, p) for p in cls.PERCENTILES]
+            summary[group] = stats
+        return summary
+
+
+class ResponseCache:
+    """Opt-in on-disk cache of replies to identical requests, kept in SQLite.
+
+    The key is a hash of the backend, model, messages (system prompt
+    included) and sampling parameters. Only requests whose sampling is
+    deterministic (temperature 0, top_k 1 or a fixed seed) are cached unless
+    response_cache_force is set. Entries older than
+    response_cache_max_age_days are dropped, and the least recently used
+    ones go once the cache is over response_cache_max_mb.
+    """
+    CACHE_FILENAME = "responses.sqlite3"
+    # Request fields that do not change the reply.
+    TRANSPORT_KEYS = {"model", "messages", "options", "stream", "stream_options", "keep_alive", "cache_prompt", "id_slot"}
+
+    _connection = None
+    _lock = threading.RLock()
+
+    @classmethod
+    def connection(cls):
+        if cls._connection is None:
+            connection = sqlite3.connect(data_path(cls.CACHE_FILENAME), check_same_thread=False)
+            connection.executescript("""
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, timings TEXT,
+                                                      created REAL NOT NULL, used REAL NOT NULL, size INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS responses_used ON responses (used);
+                CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            """)
+            cls._connection = connection
+        return cls._connection
+
+    @staticmethod
+    def sampling_params(data):
+        params = dict(data.get("options") or {})
+        params.update((key, value) for key, value in data.items() if key not in ResponseCache.TRANSPORT_KEYS)
+        return params
+
+    @staticmethod
+    def deterministic(params):
+        try:
+            if params.get("temperature") is not None and float(params["temperature"]) == 0:
+                return True
+            if params.get("top_k") is not None and int(params["top_k"]) == 1:
+                return True
+            return params.get("seed") is not None and int(params["seed"]) >= 0
+        except (TypeError, ValueError):
+            return False
+
+    @classmethod
+    def key_for(cls, config, mode, data):
+        """Cache key for a request built by build_chat_request, or None when it must not be cached."""
+        if not config.get("response_cache"):
+            return None
+        params = cls.sampling_params(data)
+        if not config.get("response_cache_force") and not cls.deterministic(params):
+            return None
+        canonical = json.dumps({"backend": mode, "model": data.get("model"), "messages": data.get("messages"), "params": params},
+                               sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get(cls, key):
+        """Return (response, timings) cached under key, or None; counts the hit or miss."""
+        now = time.time()
+        max_age = float(ConfigManager.load_config().get("response_cache_max_age_days", 30)) * 86400
+        # Entries past the age limit only go at the next put(); never serve them meanwhile.
+        oldest = now - max_age if max_age > 0 else 0
+        with cls._lock:
+            connection = cls.connection()
+            row = connection.execute("SELECT response, timings FROM responses WHERE key = ? AND created >= ?",
+                                     (key, oldest)).fetchone()
+            with connection:
+                if row is not None:
+                    connection.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+                connection.execute("INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+                                   ("hits" if row is not None else "misses",))
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]) if row[1] else None
+
+    @classmethod
+    def put(cls, key, response, timings=None):
+        config = ConfigManager.load_config()
+        now = time.time()
+        size = len(key) + len(response.encode('utf-8'))
+        with cls._lock:
+            connection = cls.connection()
+            with connection:
+                connection.execute("INSERT OR REPLACE INTO responses (key, response, timings, created, used, size) VALUES (?, ?, ?, ?, ?, ?)",
+                                   (key, response, json.dumps(timings) if timings else None, now, now, size))
+                cls.evict(connection, config, now)
+
+    @staticmethod
+    def evict(connection, config, now):
+        max_age = float(config.get("response_cache_max_age_days", 30)) * 86400
+        if max_age > 0:
+            connection.execute("DELETE FROM responses WHERE created < ?", (now - max_age,))
+        excess = connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] \
+            - float(config.get("response_cache_max_mb", 50)) * 1024 * 1024
+        if excess <= 0:
+            return
+        stale = []
+        for key, size in connection.execute("SELECT key, size FROM responses ORDER BY used"):
+            if excess <= 0:
+                break
+            stale.append((key,))
+            excess -= size
+        connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    @classmethod
+    def stats(cls):
+        """Return entries, bytes, hits and misses."""
+        with cls._lock:
+            connection = cls.connection()
+            entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            counters = dict(connection.execute("SELECT name, value FROM counters"))
+        return {"entries": entries, "bytes": size, "hits": counters.get("hits", 0), "misses": counters.get("misses", 0)}
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            connection = cls.connection()
+            with connection:
+                connection.execute("DELETE FROM responses")
+                connection.execute("DELETE FROM counters")
+
+
+class ChatRequest:
+    """One chat completion request to Ollama, llama.cpp or OpenAI.
+
+    Progress is reported through the on_token, on_timings, on_response and
+    on_error callbacks, so the GUI's NetworkWorker and the CLI run the same
+    request code. run() blocks until the reply is complete.
+    """
+
+    def __init__(self, endpoint, data, headers=None, stream=False, protocol="openai", route=None):
+        self.endpoint = endpoint
+        self.data = data
+        self.headers = headers if headers else {"Content-Type": "application/json"}
+        self.stream = stream
+        self.protocol = protocol
+        # (host group, chat) when the endpoint was picked by HostBalancer.
+        self.route = route
+        self.on_token = self.on_timings = self.on_response = self.on_error = lambda value: None
+        self.tokens = []
+        self.response = None
+        self.latency = None
+        self.cancel_requested = False
+        # Set by the caller to have the request recorded in MetricsStore.
+        self.metrics_tags = None
+        self.queued_at = time.monotonic()
+        self.first_token_at = None
+        self.usage = None
+        self.timings = None
+        self.succeeded = False
+        # Measurements of the last attempt, filled in when it ends.
+        self.metrics = None
+        # Set by the caller to store a successful reply in ResponseCache.
+        self.cache_key = None
+
+    def run(self):
+        import requests
+
+        queue_seconds = time.monotonic() - self.queued_at
+        # Hosts this request has failed on, so failover gives up once every host is down.
+        tried = set()
+        while True:
+            host = urlsplit(self.endpoint).netloc
+            attempt_started = time.monotonic()
+            if self.route:
+                HostBalancer.begin(host)
+            try:
+                self.dispatch()
+                return
+            except requests.RequestException as e:
+                if self.cancel_requested:
+                    return
+                # Nothing has been shown yet, so a dead host can be swapped for another.
+                if self.route and not self.tokens and isinstance(e, (requests.ConnectionError, requests.Timeout)):
+                    tried.add(host)
+                    next_host = HostBalancer.failover(*self.route, host, tried)
+                    if next_host is not None:
+                        self.endpoint = self.endpoint.replace(host, next_host, 1)
+                        continue
+                self.on_error(str(e))
+                return
+            finally:
+                if self.route:
+                    HostBalancer.finish(host, self.latency)
+                self.record_metrics(host, queue_seconds, attempt_started)
+                self.latency = None
+                queue_seconds = 0
+
+    def post(self, data, stream=False):
+        response = Transport.post(self.endpoint, headers=self.headers, json=data, stream=stream)
+        # Time until the response headers arrived: prompt processing for a stream.
+        self.latency = response.elapsed.total_seconds()
+        return response
+
+    def add_token(self, token):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.tokens.append(token)
+        if self.stream:
+            self.on_token(token)
+
+    def partial_text(self):
+        """The reply so far, as shown to the user: nothing unless it was streamed."""
+        return "".join(self.tokens).strip() if self.stream else ""
+
+    def emit_timings(self, timings):
+        self.timings = timings
+        self.on_timings(timings)
+
+    def record_metrics(self, host, queue_seconds, attempt_started):
+        finished = time.monotonic()
+        usage, timings = self.usage or {}, self.timings or {}
+        prompt_tokens = usage.get("prompt_tokens", timings.get("prompt_n"))
+        completion_tokens = usage.get("completion_tokens", timings.get("predicted_n"))
+        if completion_tokens is None and self.tokens:
+            completion_tokens = len(self.tokens)
+
+        ttft = self.first_token_at - attempt_started if self.first_token_at else None
+        generating = finished - (self.first_token_at or attempt_started)
+        if timings.get("predicted_per_second"):
+            tokens_per_s = timings["predicted_per_second"]
+        elif timings.get("predicted_ms") and completion_tokens:
+            tokens_per_s = completion_tokens * 1000 / timings["predicted_ms"]
+        else:
+            tokens_per_s = completion_tokens / generating if completion_tokens and generating > 0 else None
+
+        outcome = "cancelled" if self.cancel_requested else ("ok" if self.succeeded else "error")
+        self.metrics = {
+            "time": time.time(),
+            "host": host or "api.openai.com",
+            "stream": self.stream,
+            "outcome": outcome,
+            "queue_ms": round(queue_seconds * 1000, 1),
+            "headers_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+            "total_ms": round((finished - attempt_started) * 1000, 1),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "tokens_per_s": round(tokens_per_s, 2) if tokens_per_s else None
+        }
+        if self.metrics_tags is not None:
+            MetricsStore.record(dict(self.metrics_tags, **self.metrics))
+
+    def dispatch(self):
+        # Replies are always requested as a stream, even when they are only
+        # shown once complete: a non-streaming backend sends nothing until it
+        # is done, which would leave cancel() no connection to drop.
+        if self.protocol == "ollama":
+            self.run_ollama()
+        else:
+            self.run_streaming()
+
+    def cancel(self):
+        """Stop the generation and drop the connection so the backend frees its slot."""
+        self.cancel_requested = True
+        response = self.response
+        if response is None:
+            return
+        # requests has no public abort; shutting the socket down wakes the blocked read.
+        try:
+            response.raw._connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+    def emit_result(self, text):
+        # A cancelled generation's partial text is saved by whoever cancelled it.
+        if not self.cancel_requested:
+            self.succeeded = True
+            if self.cache_key is not None and text:
+                ResponseCache.put(self.cache_key, text, self.timings)
+            self.on_response(text)
+
+    def run_ollama(self):
+        """Talk to Ollama's native /api/chat, which streams one JSON object per line."""
+        data = dict(self.data, stream=True)
+        with self.post(data, stream=True) as response:
+            self.response = response
+            if response.status_code != 200:
+                self.on_error(f"{response.status_code} - {response.text}")
+                return
+
+            for raw_line in response.iter_lines():
+                if self.cancel_requested:
+                    break
+                if not raw_line:
+                    continue
+                try:
+                    event = json.loads(raw_line)
+                except ValueError:
+                    event = None
+                if not isinstance(event, dict):
+                    self.on_error(f"Invalid response from Ollama: {raw_line[:200]!r}")
+                    return
+                if event.get("error"):
+                    self.on_error(event["error"])
+                    return
+                token = (event.get("message") or {}).get("content")
+                if token:
+                    self.add_token(token)
+                if event.get("done"):
+                    self.emit_timings(self.ollama_timings(event))
+                    break
+
+            self.emit_result("".join(self.tokens).strip())
+
+    @staticmethod
+    def ollama_timings(event):
+        """Translate Ollama's nanosecond durations into llama.cpp-style timings."""
+        return {
+            "load_ms": event.get("load_duration", 0) / 1e6,
+            "prompt_n": event.get("prompt_eval_count", 0),
+            "prompt_ms": event.get("prompt_eval_duration", 0) / 1e6,
+            "predicted_n": event.get("eval_count", 0),
+            "predicted_ms": event.get("eval_duration", 0) / 1e6
+        }
+
+    def run_streaming(self):
+        """Read a server-sent event stream, collecting each token as it arrives."""
+        # include_usage adds a final chunk with the token counts.
+        data = dict(self.data, stream=True, stream_options={"include_usage": True})
+        with self.post(data, stream=True) as response:
+            self.response = response
+            if response.status_code != 200:
+                self.on_error(f"{response.status_code} - {response.text}")
+                return
+
+            timings = None
+            events_seen = False
+            other_lines = []
+            for raw_line in response.iter_lines():
+                if self.cancel_requested:
+                    break
+                line = raw_line.decode('utf-8', errors='replace')
+                event, done = self.parse_stream_line(line)
+                if done:
+                    break
+                if event is None:
+                    if line.strip():
+                        other_lines.append(line)
+                    continue
+                events_seen = True
+                # llama.cpp reports its prompt/generation timings on the final chunk.
+                timings = event.get("timings") or timings
+                self.usage = event.get("usage") or self.usage
+                choices = event.get("choices") or []
+                token = (choices[0].get("delta") or {}).get("content") if choices else None
+                if token:
+                    self.add_token(token)
+
+            if not events_seen and other_lines and not self.cancel_requested:
+                # A backend that ignores "stream" answers with one JSON body.
+                self.read_json_reply("\n".join(other_lines))
+                return
+            if timings:
+                self.emit_timings(timings)
+            self.emit_result("".join(self.tokens).strip())
+
+    def read_json_reply(self, text):
+        try:
+            response_json = json.loads(text)
+            bot_message = response_json["choices"][0]["message"]["content"].strip()
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+            self.on_error(f"Invalid response: {text[:200]!r}")
+            return
+        self.usage = response_json.get("usage")
+        if response_json.get("timings"):
+            self.emit_timings(response_json["timings"])
+        self.emit_result(bot_message)
+
+    @staticmethod
+    def parse_stream_line(line):
+        """Return (event, done) for one line of an OpenAI-style SSE stream."""
+        if not line.startswith("data:"):
+            return None, False
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            return None, True
+        try:
+            event = json.loads(payload)
+        except json.JSONDecodeError:
+            return None, False
+        return (event, False) if isinstance(event, dict) else (None, False)
+
+
+def system_content(system_prompt, summary=None):
+    """The system message text: the chat's prompt plus the rolling summary, if any."""
+    content = system_prompt if system_prompt else "You are a helpful assistant."
+    if summary:
+        content += f"\n\nSummary of the earlier conversation:\n{summary['summary']}"
+    return content
+
+
+def build_messages(config, mode, model, system_prompt, history, context_window, summary=None, anchor_key=None):
+    """The messages to send for history: system prompt first, then what fits the model's budget."""
+    system_message = {"role": "system", "content": system_content(system_prompt, summary)}
+    budget = ContextWindow.budget_for(config, mode, model)
+    covered = summary["covered"] if summary else 0
+    return context_window.fit(system_message, history, budget, first=covered, anchor_key=anchor_key)
+
+
+def pick_host(config, group, chat_filename):
+    """The host from the "ollamahost"/"llamacpphost" list that serves chat_filename."""
+    hosts = HostBalancer.parse_hosts(config.get(group, ""))
+    return HostBalancer.pick(group, config['baseurl'], hosts, chat_filename)
+
+
+def build_chat_request(config, mode, model, messages, chat_filename, host=None, pin_slot=True):
+    """Return (endpoint, data, headers, protocol, route) for mode; raise ValueError if it cannot be sent.
+
+    host overrides the Ollama/llama.cpp host HostBalancer would pick for
+    chat_filename. pin_slot=False leaves the llama.cpp slot to the server,
+    for side requests that must not displace the chat's cached prompt.
+    """
+    baseurl = config['baseurl']
+    path = config['path']
+    protocol = "openai"
+    route = None
+    headers = {"Content-Type": "application/json"}
+    if mode in ('ollama', 'llama.cpp'):
+        group = 'ollamahost' if mode == 'ollama' else 'llamacpphost'
+        if host is None:
+            host = pick_host(config, group, chat_filename)
+        if host is None:
+            raise ValueError(f"No hosts configured in {group}.")
+        route = (group, chat_filename)
+
+    if mode == 'ollama' and config.get("ollama_native", True):
+        full_endpoint = f"{baseurl}{host}/api/chat"
+        data = {
+            "model": model,
+            "messages": messages,
+            "keep_alive": config.get("ollama_keep_alive", "30m")
+        }
+        options = dict(config.get("sampling_params") or {}, **(config.get("ollama_options") or {}))
+        if options:
+            data["options"] = options
+        protocol = "ollama"
+    elif mode == 'ollama':
+        full_endpoint = f"{baseurl}{host}{path}"
+        data = {
+            "model": model,
+            "messages": messages
+        }
+    elif mode == 'llama.cpp':
+        full_endpoint = f"{baseurl}{host}{path}"
+        data = {
+            "messages": messages
+        }
+        if config.get("llamacpp_cache_prompt", True):
+            data["cache_prompt"] = True
+        slots = int(config.get("llamacpp_slots", 1))
+        if slots > 0 and pin_slot:
+            # Pin each chat to one server slot so its KV cache is still there next turn.
+            data["id_slot"] = zlib.crc32(chat_filename.encode('utf-8')) % slots
+    elif mode == 'openai':
+        api_key = config.get('openaiapikey')
+        if not api_key:
+            raise ValueError("OpenAI API key is not set. Please update your configuration.")
+
+        full_endpoint = "https://api.openai.com/v1/chat/completions"
+        headers["Authorization"] = f"Bearer {api_key}"
+        data = {
+            "model": model or "gpt-4o",
+            "messages": messages
+        }
+    else:
+        raise ValueError("Invalid mode selected. Please check your configuration.")
+
+    if protocol == "openai" and config.get("sampling_params"):
+        data.update(config["sampling_params"])
+    return full_endpoint, data, headers, protocol, route